@@ -0,0 +1,702 @@
+"""Бенчмарки бота.
+
+    python bench.py diff      — микробенчмарк диффа правок на заявках разного размера
+    python bench.py load      — нагрузочный прогон против локальных заглушек Telegram и OpenAI
+    python bench.py find      — поиск /find по истории из десятков тысяч заявок
+    python bench.py extract   — согласие локального разбора адреса с разметкой (или с ИИ)
+    python bench.py startup   — время импорта main.py и самые тяжёлые импорты
+
+Нагрузочный прогон поднимает в этом же процессе заглушки Bot API и
+chat-completions (с настраиваемой задержкой, ошибками и RetryAfter), скармливает
+диспетчеру `dp` синтетические апдейты и считает заявки/сек, p50/p95/p99
+задержки «заявка → карточка» и пиковую память. Результаты дописываются в
+bench_results.jsonl и сравниваются с предыдущим прогоном того же сценария.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from aiohttp import web
+
+ORDER_TEMPLATE = """Заказ №{n}
+Получатель: Анна, +37529{phone:07d}
+Адрес: ул. Притыцкого {house}, под. 2, эт. 5, кв. {flat}
+Доставка {day}.10 с 14:00 до 16:00
+Букет: 25 роз «Эквадор», микс, упаковка крафт
+Открытка: «С днём рождения! <3»
+Комментарий: позвонить за 30 минут, домофон не работает
+Оплачено полностью, сумма 185 BYN"""
+
+# заявка без подъезда/этажа/квартиры — такие уходят на проверку ИИ
+PARTIAL_ORDER_TEMPLATE = """Заказ №{n}
+Получатель: Олег, @oleg_{n}
+Адрес: Тимирязева {house}, вход со двора
+Доставка {day}.10 к 18:00, букет тюльпанов 15 шт
+Оплата при получении"""
+
+BOT_TOKEN = "123456:BENCH-TOKEN"
+ADMIN_ID = 542345855
+
+def import_main():
+    """Импортирует main.py с тестовым окружением (без настоящих токенов и данных)."""
+    os.environ.setdefault("BOT_TOKEN", BOT_TOKEN)
+    os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+    os.environ.setdefault("UNIQUE_USER_ID", str(ADMIN_ID))
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bot-bench-"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+    return main
+
+def make_order(n: int, partial: bool = False) -> str:
+    template = PARTIAL_ORDER_TEMPLATE if partial else ORDER_TEMPLATE
+    return template.format(n=n, phone=1234567 + n, house=10 + n % 50, flat=n % 200, day=1 + n % 28)
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+# ================== ДИФФ ==================
+
+def diff_cases() -> dict[str, tuple[str, str]]:
+    order = make_order(1)
+    lines = order.splitlines()
+    big = "\n".join(make_order(n) for n in range(60))  # ~500 строк
+    big_lines = big.splitlines()
+    return {
+        "без изменений": (order, order),
+        "одна строка": (order, order.replace("кв. 1", "кв. 17")),
+        "добавлена строка": (order, order + "\nДоставка к подъезду со двора"),
+        "перестановка": (order, "\n".join([lines[0], lines[3], lines[1], lines[2], *lines[4:]])),
+        "дубль строки": (order, order + "\n" + lines[-1]),
+        "переписана целиком": (order, make_order(2)),
+        "большая, одна строка": (big, big.replace("кв. 30", "кв. 31", 1)),
+        "большая, каждая 10-я": (big, "\n".join(l + " !" if i % 10 == 0 else l for i, l in enumerate(big_lines))),
+    }
+
+def bench_diff(args):
+    main = import_main()
+    print(f"{'случай':<24}{'мкс/вызов':>12}{'строк':>8}")
+    for name, (old, new) in diff_cases().items():
+        timer = timeit.Timer(lambda: main.diff_text(old, new))
+        number, _ = timer.autorange()
+        per_call = statistics.median(timer.repeat(repeat=args.repeat, number=number)) / number
+        print(f"{name:<24}{per_call * 1e6:>12.1f}{len(main.diff_text(old, new)):>8}")
+
+# ================== ПОИСК ПО ИСТОРИИ ==================
+
+def bench_find(args):
+    main = import_main()
+    shops = list(main.shop_config.shops.values())
+    start = time.perf_counter()
+    for n in range(args.orders):
+        shop = shops[n % len(shops)]
+        record = main.OrderRecord(
+            card_id=n + 1,
+            orig_chat_id=shop.chat_id,
+            orig_msg_id=n + 1,
+            original_text=make_order(n, partial=n % 3 == 0),
+            request_number=f"{n % 100:02d} / 17.10.2026",
+            chat_name=shop.name,
+        )
+        # история за несколько месяцев: по ~100 заявок в день
+        record.created_at = time.time() - (args.orders - n) * 864
+        main.storage.save_history(record)
+        if n % 1000 == 999:
+            main.storage.flush()
+    main.storage.flush()
+    print(f"проиндексировано {args.orders} заявок за {time.perf_counter() - start:.1f} с")
+
+    queries = ["+3752912", "+375291234567", "@oleg_30", "притыц", "millionroz", "17.10", "+37529 притыц"]
+    print(f"{'запрос':<24}{'мс':>10}{'найдено':>10}")
+    for query in queries:
+        groups = main.parse_find_query(query)
+        timer = timeit.Timer(lambda: main.storage.search_history(groups, main.FIND_LIMIT + 1))
+        number, _ = timer.autorange()
+        per_call = statistics.median(timer.repeat(repeat=args.repeat, number=number)) / number
+        print(f"{query:<24}{per_call * 1e3:>10.2f}{len(main.storage.search_history(groups, 1000)):>10}")
+
+# ================== РАЗБОР АДРЕСА ==================
+
+# Размеченные вручную заявки: какие поля адреса в них есть — так, как на них
+# отвечает ИИ по ADDRESS_AI_PROMPT. Поля: s — улица, h — дом, e — подъезд,
+# f — этаж, a — квартира.
+ADDRESS_CORPUS = [
+    ("Адрес: ул. Притыцкого 29, под. 2, эт. 5, кв. 17", "shefa"),
+    ("ул. Притыцкого, д. 29, подъезд 2, этаж 5, квартира 17", "shefa"),
+    ("пр-т Независимости 45, 3 подъезд, 7 этаж, кв 112", "shefa"),
+    ("Доставка: улица Сурганова д.57б, п.1, эт.9, кв.81", "shefa"),
+    ("пер. Козлова 7, пд 3, этаж 2, оф. 14", "shefa"),
+    ("Тимирязева 67, под 4 эт 6 кв 88", "shefa"),
+    ("Адрес: Победителей, 100, подъезд 1, 12-й этаж, кв. 140", "shefa"),
+    ("б-р Шевченко 8, под. 5, эт. 3, кв. 61, домофон 61", "shefa"),
+    ("мкр Уручье, ул. Ложинская 4, 2 подъезд, 4 этаж, кв. 30", "shefa"),
+    ("Получатель Анна, Тимирязева 67, вход со двора", "sh"),
+    ("ул. Кальварийская 21, офис 305", "sha"),
+    ("пр-т Победителей 9, ТЦ Галерея, 3 этаж", "shf"),
+    ("ул. Немига 5", "sh"),
+    ("Немига 5, кв. 12", "sha"),
+    ("ул. Мельникайте 2, под. 1, кв. 40", "shea"),
+    ("Притыцкого 29, этаж 5", "shf"),
+    ("доставить на ул. Якуба Коласа, д. 12, кв 5", "sha"),
+    ("Адрес уточнить по телефону +375291234567", ""),
+    ("Самовывоз с Белинского, 23", "sh"),
+    ("Заберут из магазина в 18:00", ""),
+    ("Букет 25 роз, открытка, доставка 17.10 к 14:00", ""),
+    ("Адрес: Логойский тракт 15/4, под. 3, эт. 10, кв. 210", "shefa"),
+    ("Дзержинского 104 к 2, подъезд 6, этаж 14, квартира 431", "shefa"),
+    ("ул Ленина 3 под 1 эт 2 кв 4", "shefa"),
+    ("Адрес: Партизанский пр., 14, кв. 9", "sha"),
+    ("ул. Гикало, 4; 1-й подъезд; 3 этаж", "shef"),
+    ("Минск, Ольшевского 22, кв 73", "sha"),
+    ("дом 8, кв 15 (улицу скажет получатель)", "ha"),
+]
+
+CORPUS_FIELDS = {"s": "street", "h": "house", "e": "entrance", "f": "floor", "a": "apartment"}
+
+def corpus_labels(marks: str) -> dict[str, bool]:
+    return {field: key in marks for key, field in CORPUS_FIELDS.items()}
+
+def agreement_report(main, reference: list[dict[str, bool]]) -> None:
+    """Доля совпадений разбора с эталоном: по полям, по заявке целиком и на быстром пути."""
+    fields = list(CORPUS_FIELDS.values())
+    per_field = dict.fromkeys(fields, 0)
+    whole = fast = fast_agree = 0
+    for (text, _), expected in zip(ADDRESS_CORPUS, reference):
+        verdict, confidence = main.extract_address(text)
+        agree = True
+        for field in fields:
+            if verdict[field] == expected[field]:
+                per_field[field] += 1
+            else:
+                agree = False
+        whole += agree
+        if confidence >= main.ADDRESS_RULES_CONFIDENCE:
+            # на быстром пути ИИ не спрашивают — ошибка здесь доходит до Исполнителя
+            fast += 1
+            fast_agree += agree
+        if not agree:
+            got = "".join(k for k, f in CORPUS_FIELDS.items() if verdict[f])
+            want = "".join(k for k, f in CORPUS_FIELDS.items() if expected[f])
+            path = "быстрый путь" if confidence >= main.ADDRESS_RULES_CONFIDENCE else "уйдёт к ИИ"
+            print(f"  расхождение ({path}, {confidence:.1f}): разбор {got or '—'}, эталон {want or '—'}: {text}")
+
+    total = len(ADDRESS_CORPUS)
+    print(f"\nЗаявок: {total}")
+    for field in fields:
+        print(f"  {field:<12}{per_field[field] / total * 100:>6.1f}%")
+    print(f"  {'все поля':<12}{whole / total * 100:>6.1f}%")
+    print(f"Быстрый путь (уверенность ≥ {main.ADDRESS_RULES_CONFIDENCE}): {fast} из {total}, "
+          f"совпадает с эталоном {fast_agree / fast * 100 if fast else 0:.1f}%")
+
+def bench_extract(args):
+    main = import_main()
+    if args.ai:
+        # эталон — ответы настоящего ИИ (нужен рабочий OPENAI_API_KEY)
+        async def ask_all():
+            return [await main.check_address_with_ai(text) for text, _ in ADDRESS_CORPUS]
+        answers = asyncio.run(ask_all())
+        reference = [{field: bool(answer.get(field)) for field in CORPUS_FIELDS.values()} for answer in answers]
+        labelled = sum(ref == corpus_labels(marks) for ref, (_, marks) in zip(reference, ADDRESS_CORPUS))
+        print(f"ИИ совпал с ручной разметкой в {labelled} из {len(ADDRESS_CORPUS)} заявок")
+    else:
+        reference = [corpus_labels(marks) for _, marks in ADDRESS_CORPUS]
+    agreement_report(main, reference)
+
+    texts = [text for text, _ in ADDRESS_CORPUS]
+    timer = timeit.Timer(lambda: [main.extract_address(text) for text in texts])
+    number, _ = timer.autorange()
+    per_call = statistics.median(timer.repeat(repeat=args.repeat, number=number)) / number / len(texts)
+    print(f"Разбор: {per_call * 1e6:.1f} мкс на заявку")
+
+# ================== ЗАГЛУШКИ TELEGRAM И OPENAI ==================
+
+class FaultInjection:
+    """Задержка ответа и доля ошибок/RetryAfter для заглушки."""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float, retry_after_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+
+    async def delay(self):
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def roll(self) -> str | None:
+        x = random.random()
+        if x < self.error_rate:
+            return "error"
+        if x < self.error_rate + self.retry_after_rate:
+            return "retry_after"
+        return None
+
+class Server:
+    def __init__(self):
+        self.app = web.Application()
+        self.runner: web.AppRunner | None = None
+        self.port = 0
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", 0).start()
+        self.port = self.runner.addresses[0][1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+class FakeTelegram(Server):
+    """Минимальный Bot API: отвечает на методы, которые вызывает бот, и запоминает отправленное."""
+
+    def __init__(self, faults: FaultInjection):
+        super().__init__()
+        self.faults = faults
+        self.next_message_id = 1_000_000
+        self.calls: dict[str, int] = {}
+        # (время, chat_id, message_id, method, text, есть ли клавиатура)
+        self.sent: list[tuple[float, int, int, str, str, bool]] = []
+        self.waiters: list[tuple[asyncio.Future, object]] = []
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+
+        await self.faults.delay()
+        fault = self.faults.roll() if method not in ("getMe", "deleteWebhook", "setWebhook") else None
+        if fault == "error":
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+        if fault == "retry_after":
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1},
+            }, status=429)
+
+        result = True
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(data["chat_id"])
+            if method == "sendMessage":
+                self.next_message_id += 1
+                message_id = self.next_message_id
+            else:
+                message_id = int(data["message_id"])
+            text = data.get("text", "")
+            self.sent.append((time.perf_counter(), chat_id, message_id, method, text, bool(data.get("reply_markup"))))
+            self._notify(self.sent[-1])
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "text": text,
+            }
+        return web.json_response({"ok": True, "result": result})
+
+    def _notify(self, item):
+        for future, predicate in list(self.waiters):
+            if not future.done() and predicate(item):
+                future.set_result(item)
+                self.waiters.remove((future, predicate))
+
+    def wait_for(self, predicate) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append((future, predicate))
+        return future
+
+class FakeOpenAI(Server):
+    """chat.completions (одиночные и пачки): вердикт строится локальным разбором адреса."""
+
+    def __init__(self, faults: FaultInjection, main):
+        super().__init__()
+        self.faults = faults
+        self.main = main
+        self.requests = 0
+        self.app.router.add_post("/v1/chat/completions", self.handle)
+
+    def verdict(self, text: str) -> dict:
+        verdict, _ = self.main.extract_address(text)
+        return verdict
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        await self.faults.delay()
+        if self.faults.roll():
+            return web.json_response({"error": {"message": "upstream error", "type": "server_error"}}, status=500)
+
+        user_content = body["messages"][-1]["content"]
+        if user_content.startswith("["):
+            # пачка: [{"id", "text"}] -> {"results": [{"id", ...вердикт}]}
+            results = [{"id": item["id"], **self.verdict(item["text"])} for item in json.loads(user_content)]
+            content = json.dumps({"results": results}, ensure_ascii=False)
+        else:
+            content = json.dumps(self.verdict(user_content), ensure_ascii=False)
+        return web.json_response({
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+# ================== СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ==================
+
+class UpdateFactory:
+    def __init__(self, admin_id: int):
+        self.admin_id = admin_id
+        self.update_id = 0
+        self.message_id = 0
+
+    def _next_update_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def order(self, chat_id: int, thread_id: int, text: str) -> dict:
+        self.message_id += 1
+        return {
+            "update_id": self._next_update_id(),
+            "message": self._message(chat_id, thread_id, self.message_id, text),
+        }
+
+    def edit(self, chat_id: int, thread_id: int, message_id: int, text: str) -> dict:
+        message = self._message(chat_id, thread_id, message_id, text)
+        message["edit_date"] = int(time.time())
+        return {"update_id": self._next_update_id(), "edited_message": message}
+
+    def callback(self, card_id: int, data: str) -> dict:
+        return {
+            "update_id": self._next_update_id(),
+            "callback_query": {
+                "id": str(self.update_id),
+                "from": {"id": self.admin_id, "is_bot": False, "first_name": "Admin"},
+                "chat_instance": "bench",
+                "message": {
+                    "message_id": card_id,
+                    "date": int(time.time()),
+                    "chat": {"id": self.admin_id, "type": "private", "first_name": "Admin"},
+                    "text": "card",
+                },
+                "data": data,
+            },
+        }
+
+    @staticmethod
+    def _message(chat_id: int, thread_id: int, message_id: int, text: str) -> dict:
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "Shop", "is_forum": True},
+            "from": {"id": 777000 + message_id % 50, "is_bot": False, "first_name": "Shop"},
+            "message_thread_id": thread_id,
+            "is_topic_message": True,
+            "text": text,
+        }
+
+# ================== СЦЕНАРИИ ==================
+
+async def feed(main, update: dict):
+    await main.dp.feed_raw_update(main.bot, update)
+
+async def scenario_burst(main, tg: FakeTelegram, factory: UpdateFactory, args) -> dict:
+    """Утренний поток: заявки во все чаты магазинов, --rate штук в секунду."""
+    chats = [(shop.chat_id, shop.thread_id) for shop in main.shop_config.shops.values()]
+    latencies = []
+    tasks = []
+    start = time.perf_counter()
+
+    async def one(n: int):
+        chat_id, thread_id = chats[n % len(chats)]
+        text = make_order(n, partial=random.random() < args.partial_share)
+        marker = f"Заказ №{n}\n"
+        card = tg.wait_for(lambda item: item[1] == main.UNIQUE_USER_ID and item[3] == "sendMessage" and marker in item[4])
+        fed_at = time.perf_counter()
+        await feed(main, factory.order(chat_id, thread_id, text))
+        sent_at = (await asyncio.wait_for(card, timeout=args.timeout))[0]
+        latencies.append(sent_at - fed_at)
+
+    for n in range(args.orders):
+        tasks.append(asyncio.create_task(one(n)))
+        if args.rate:
+            await asyncio.sleep(1 / args.rate)
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    return summarize(latencies, elapsed, errors=sum(isinstance(r, Exception) for r in results))
+
+async def scenario_edits(main, tg: FakeTelegram, factory: UpdateFactory, args) -> dict:
+    """Шторм правок: каждая из --orders заявок правится --edits раз подряд."""
+    chats = [(shop.chat_id, shop.thread_id) for shop in main.shop_config.shops.values()]
+    originals = []
+    for n in range(args.orders):
+        chat_id, thread_id = chats[n % len(chats)]
+        update = factory.order(chat_id, thread_id, make_order(n))
+        await feed(main, update)
+        originals.append((chat_id, thread_id, update["message"]["message_id"], make_order(n)))
+    await asyncio.sleep(0.2)
+
+    calls_before = sum(tg.calls.values())
+    start = time.perf_counter()
+    for k in range(args.edits):
+        await asyncio.gather(*(
+            feed(main, factory.edit(chat_id, thread_id, message_id, text + f"\nПравка {k}"))
+            for chat_id, thread_id, message_id, text in originals
+        ))
+    fed = time.perf_counter() - start
+    # ждём, пока отработает debounce и уйдут уведомления
+    await asyncio.sleep(main.EDIT_DEBOUNCE + 1)
+    calls = sum(tg.calls.values()) - calls_before
+    result = summarize([], fed, errors=0)
+    result.update({"edits": args.orders * args.edits, "telegram_calls": calls})
+    return result
+
+async def scenario_callbacks(main, tg: FakeTelegram, factory: UpdateFactory, args) -> dict:
+    """Поток нажатий: по карточке на заявку, затем «Принять» по каждой."""
+    chats = [(shop.chat_id, shop.thread_id) for shop in main.shop_config.shops.values()]
+    for n in range(args.orders):
+        chat_id, thread_id = chats[n % len(chats)]
+        await feed(main, factory.order(chat_id, thread_id, make_order(n)))
+    await asyncio.sleep(0.2)
+    cards = [item[2] for item in tg.sent if item[1] == main.UNIQUE_USER_ID and item[5] and item[3] == "sendMessage"]
+
+    latencies = []
+    start = time.perf_counter()
+
+    async def one(card_id: int):
+        fed_at = time.perf_counter()
+        await feed(main, factory.callback(card_id, "decision:accept"))
+        latencies.append(time.perf_counter() - fed_at)
+
+    results = await asyncio.gather(*(one(card_id) for card_id in cards), return_exceptions=True)
+    return summarize(latencies, time.perf_counter() - start, errors=sum(isinstance(r, Exception) for r in results))
+
+SCENARIOS = {
+    "burst": scenario_burst,
+    "edits": scenario_edits,
+    "callbacks": scenario_callbacks,
+}
+
+def summarize(latencies: list[float], elapsed: float, errors: int) -> dict:
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "per_sec": round(len(latencies) / elapsed, 1) if elapsed and latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+# ================== СТАРТ ==================
+
+def bench_env() -> dict:
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", BOT_TOKEN)
+    env.setdefault("OPENAI_API_KEY", "sk-test")
+    env.setdefault("UNIQUE_USER_ID", str(ADMIN_ID))
+    env.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="bot-bench-"))
+    return env
+
+def parse_importtime(stderr: str, root: str = "main") -> dict[str, int]:
+    """Кумулятивное время (мкс) прямых импортов модуля root из вывода -X importtime."""
+    # модуль печатается после своих импортов, вложенность — два пробела за уровень
+    pending: dict[int, list[tuple[str, int]]] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        children = pending.pop(level + 1, [])
+        if name.strip() == root:
+            return dict(children)
+        pending.setdefault(level, []).append((name.strip(), int(cumulative)))
+    return {}
+
+def bench_startup(args):
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    env = bench_env()
+    wall, imports = [], {}
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import main"],
+            cwd=cwd, env=env, capture_output=True, text=True,
+        )
+        wall.append(time.perf_counter() - start)
+        if proc.returncode != 0:
+            sys.exit(proc.stderr)
+        for name, micros in parse_importtime(proc.stderr).items():
+            imports.setdefault(name, []).append(micros)
+
+    top = sorted(((statistics.median(v), k) for k, v in imports.items()), reverse=True)[:args.top]
+    print(f"Импорт main.py: медиана {statistics.median(wall) * 1000:.0f} мс из {args.repeat} запусков")
+    for micros, name in top:
+        print(f"  {name:<30}{micros / 1000:>8.1f} мс")
+
+    record = {
+        "scenario": "startup",
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "params": {"repeat": args.repeat},
+        "result": {
+            "import_ms": round(statistics.median(wall) * 1000, 1),
+            "top_imports_ms": {name: round(micros / 1000, 1) for micros, name in top},
+        },
+    }
+    compare_with_previous(args.results, record)
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+# ================== ЗАПУСК И ИСТОРИЯ ==================
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare_with_previous(path: str, record: dict):
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                item = json.loads(line)
+                if item["scenario"] == record["scenario"] and item["params"] == record["params"]:
+                    previous = item
+    if previous is None:
+        return
+    print(f"\nСравнение с {previous['revision']} ({previous['timestamp']}):")
+    for key in ("per_sec", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb", "import_ms"):
+        old, new = previous["result"].get(key), record["result"].get(key)
+        if old and new is not None:
+            print(f"  {key:<12}{old:>10} → {new:<10}({(new - old) / old * 100:+.1f}%)")
+
+async def run_load(args) -> dict:
+    random.seed(args.seed)
+    tg = FakeTelegram(FaultInjection(args.tg_latency, args.tg_latency / 2, args.tg_errors, args.tg_retry_after))
+    await tg.start()
+
+    os.environ["TELEGRAM_API_URL"] = tg.url
+    os.environ["EDIT_DEBOUNCE"] = str(args.edit_debounce)
+    if not args.realistic_limits:
+        # меряем сам бот, а не лимиты Telegram
+        for name in ("TG_GLOBAL_RATE", "TG_GROUP_RATE", "TG_PRIVATE_RATE"):
+            os.environ[name] = "100000"
+    if args.force_ai:
+        os.environ["ADDRESS_RULES_CONFIDENCE"] = "2"
+
+    openai_server = FakeOpenAI(FaultInjection(args.ai_latency, args.ai_latency / 2, args.ai_errors), None)
+    await openai_server.start()
+    os.environ["OPENAI_BASE_URL"] = openai_server.url + "/v1"
+
+    main = import_main()
+    openai_server.main = main
+    # бенчмарк не должен зависеть от времени суток
+    main.is_night_time = lambda *a, **kw: False
+
+    factory = UpdateFactory(main.UNIQUE_USER_ID)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        result = await SCENARIOS[args.scenario](main, tg, factory, args)
+    finally:
+        await main.bot.session.close()
+        await tg.stop()
+        await openai_server.stop()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result["peak_rss_mb"] = round(rss / 1024, 1)
+    result["rss_growth_mb"] = round((rss - rss_before) / 1024, 1)
+    result["ai_requests"] = openai_server.requests
+    result["telegram_calls"] = result.get("telegram_calls", sum(tg.calls.values()))
+    return result
+
+def bench_load(args):
+    result = asyncio.run(run_load(args))
+    params = {
+        key: getattr(args, key)
+        for key in (
+            "orders", "rate", "edits", "partial_share", "force_ai", "realistic_limits",
+            "tg_latency", "tg_errors", "tg_retry_after", "ai_latency", "ai_errors",
+        )
+    }
+    record = {
+        "scenario": args.scenario,
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "params": params,
+        "result": result,
+    }
+    print(json.dumps(record, ensure_ascii=False, indent=2))
+    compare_with_previous(args.results, record)
+    with open(args.results, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    diff = sub.add_parser("diff", help="микробенчмарк диффа правок")
+    diff.add_argument("--repeat", type=int, default=5)
+    diff.set_defaults(func=bench_diff)
+
+    extract = sub.add_parser("extract", help="согласие разбора адреса с размеченным корпусом")
+    extract.add_argument("--ai", action="store_true", help="эталон — ответы ИИ (нужен OPENAI_API_KEY)")
+    extract.add_argument("--repeat", type=int, default=5)
+    extract.set_defaults(func=bench_extract)
+
+    find = sub.add_parser("find", help="поиск по истории заявок")
+    find.add_argument("--orders", type=int, default=20000, help="заявок в истории")
+    find.add_argument("--repeat", type=int, default=5)
+    find.set_defaults(func=bench_find)
+
+    startup = sub.add_parser("startup", help="время импорта main.py")
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.add_argument("--top", type=int, default=10, help="сколько самых тяжёлых импортов показать")
+    startup.add_argument("--results", default="bench_results.jsonl", help="файл истории прогонов")
+    startup.set_defaults(func=bench_startup)
+
+    load = sub.add_parser("load", help="нагрузочный прогон против заглушек Telegram и OpenAI")
+    load.add_argument("scenario", choices=sorted(SCENARIOS))
+    load.add_argument("--orders", type=int, default=200, help="число заявок")
+    load.add_argument("--rate", type=float, default=0, help="заявок в секунду (0 — все сразу)")
+    load.add_argument("--edits", type=int, default=5, help="правок на заявку (сценарий edits)")
+    load.add_argument("--edit-debounce", type=float, default=0.5, help="EDIT_DEBOUNCE для прогона")
+    load.add_argument("--partial-share", type=float, default=0.3, help="доля заявок с неполным адресом")
+    load.add_argument("--force-ai", action="store_true", help="проверять каждый адрес через ИИ")
+    load.add_argument("--realistic-limits", action="store_true", help="оставить лимиты исходящих Telegram")
+    load.add_argument("--tg-latency", type=float, default=0.05, help="задержка Bot API, сек")
+    load.add_argument("--tg-errors", type=float, default=0.0, help="доля ответов 500 от Bot API")
+    load.add_argument("--tg-retry-after", type=float, default=0.0, help="доля ответов 429 RetryAfter")
+    load.add_argument("--ai-latency", type=float, default=1.0, help="задержка OpenAI, сек")
+    load.add_argument("--ai-errors", type=float, default=0.0, help="доля ошибок OpenAI")
+    load.add_argument("--timeout", type=float, default=120, help="сколько ждать карточку, сек")
+    load.add_argument("--seed", type=int, default=1)
+    load.add_argument("--results", default="bench_results.jsonl", help="файл истории прогонов")
+    load.set_defaults(func=bench_load)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,46 @@
 import asyncio
+import heapq
 import re
 import os
 import json
-from datetime import datetime
+import time
+import logging
+import signal
+import sys
+import sqlite3
+import hashlib
+import importlib
+import math
+import html
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from typing import Callable, NamedTuple
+from contextlib import contextmanager
+from datetime import datetime, time as dtime, timedelta
 from zoneinfo import ZoneInfo
-from difflib import ndiff
+from difflib import SequenceMatcher
 
+from aiohttp import ClientError, ClientSession, web
 from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.filters import Command, CommandObject
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramConflictError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
 from aiogram.types import (
     Message,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     CallbackQuery,
+    Update,
 )
 
-from openai import OpenAI
 
 # ================== CONFIG ==================
 
@@ -23,13 +48,107 @@ API_TOKEN = os.getenv("BOT_TOKEN", "YOUR_TOKEN_HERE")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 UNIQUE_USER_ID = int(os.getenv("UNIQUE_USER_ID", 542345855))
 
+# свой адрес Bot API (локальный сервер или заглушка для тестов), по умолчанию api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# режим webhook: если задан WEBHOOK_URL, бот принимает апдейты по HTTP вместо polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", 8080)))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+INBOX_WORKERS = int(os.getenv("INBOX_WORKERS", 8))
+
+# сколько секунд после SIGTERM дорабатывать начатое; что не успело — проигрывается при старте
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", 8))
+
+# порт HTTP с метриками Prometheus (/metrics); 0 — не поднимать
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+
+# шарды: при SHARDS > 1 главный процесс только принимает апдейты и раздаёт их
+# SHARDS процессам-шардам по chat_id; SHARD_INDEX выставляется шардам при запуске
+SHARDS = int(os.getenv("SHARDS", 1))
+SHARD_INDEX = int(os.environ["SHARD_INDEX"]) if "SHARD_INDEX" in os.environ else None
+SHARD_BASE_PORT = int(os.getenv("SHARD_BASE_PORT", 9100))
+# общий секрет главного процесса и шардов; шарды получают его через окружение
+SHARD_TOKEN = os.getenv("SHARD_TOKEN") or os.urandom(16).hex()
+# у каждого шарда свои журнал, кэш и порт метрик (METRICS_PORT + 1 + номер шарда)
+SHARD_SUFFIX = f"-{SHARD_INDEX}" if SHARD_INDEX is not None else ""
+if SHARD_INDEX is not None and METRICS_PORT:
+    METRICS_PORT += 1 + SHARD_INDEX
+# апдейты, обработка которых дольше стольких секунд, пишутся в лог
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", 2))
+
+# сколько секунд копить серию правок одной заявки и максимальная задержка с первой правки
+EDIT_DEBOUNCE = float(os.getenv("EDIT_DEBOUNCE", 20))
+EDIT_DEBOUNCE_MAX = float(os.getenv("EDIT_DEBOUNCE_MAX", 60))
+
+# сколько проверок адреса ИИ выполняется одновременно и сколько ждём ответа (сек)
+AI_CONCURRENCY = int(os.getenv("AI_CONCURRENCY", 4))
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", 8))
+# пачки проверок: сколько ждать попутчиков (сек) и максимальный размер пачки
+AI_BATCH_WINDOW = float(os.getenv("AI_BATCH_WINDOW", 0.05))
+AI_BATCH_MAX = int(os.getenv("AI_BATCH_MAX", 10))
+# сколько заявка ждёт ИИ в сумме (очередь, пачка, запрос), прежде чем уйти без него
+AI_TIMEOUT_BUDGET = float(os.getenv("AI_TIMEOUT_BUDGET", AI_TIMEOUT))
+# предохранитель: доля ошибок среди последних AI_BREAKER_WINDOW проверок (не меньше
+# AI_BREAKER_MIN_CALLS), при которой ИИ отключается на AI_BREAKER_COOLDOWN секунд
+AI_BREAKER_WINDOW = int(os.getenv("AI_BREAKER_WINDOW", 20))
+AI_BREAKER_MIN_CALLS = int(os.getenv("AI_BREAKER_MIN_CALLS", 5))
+AI_BREAKER_ERROR_RATE = float(os.getenv("AI_BREAKER_ERROR_RATE", 0.5))
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", 60))
+
+# каталог для локальных данных бота (кэш и т.п.)
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+# ночная очередь: сколько ночных заявок одновременно проверяет ИИ и размер страницы утренней сводки (символов)
+NIGHT_AI_CONCURRENCY = int(os.getenv("NIGHT_AI_CONCURRENCY", 1))
+NIGHT_DIGEST_PAGE = int(os.getenv("NIGHT_DIGEST_PAGE", 3500))
+# через сколько секунд повторить выпуск ночных заявок, карточки которых не отправились
+NIGHT_RELEASE_RETRY = float(os.getenv("NIGHT_RELEASE_RETRY", 60))
+
+# время ежедневной сводки за прошедший день (по TZ); пусто — не присылать.
+# Сразу после полуночи: в отчёт попадают и заявки, пришедшие поздно вечером
+DAILY_REPORT_TIME = os.getenv("DAILY_REPORT_TIME", "00:05")
+
+# список магазинов (JSON); перечитывается при изменении файла и по /reload
+SHOPS_PATH = os.getenv("SHOPS_PATH", os.path.join(DATA_DIR, "shops.json"))
+SHOPS_RELOAD_INTERVAL = float(os.getenv("SHOPS_RELOAD_INTERVAL", 5))
+ADDRESS_CACHE_SIZE = int(os.getenv("ADDRESS_CACHE_SIZE", 2000))
+ADDRESS_CACHE_TTL = int(os.getenv("ADDRESS_CACHE_TTL", 7 * 24 * 3600))
+
+# сколько заявок держать в памяти и сколько хранить закрытые (сек)
+ORDER_STORE_MAX = int(os.getenv("ORDER_STORE_MAX", 5000))
+ORDER_CLOSED_TTL = int(os.getenv("ORDER_CLOSED_TTL", 3 * 24 * 3600))
+
+# база состояния бота и как часто сбрасывать в неё накопленные изменения (сек)
+DB_PATH = os.getenv("DB_PATH", os.path.join(DATA_DIR, "bot.sqlite3"))
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", 0.5))
+
 TZ = ZoneInfo("Europe/Minsk")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+log = logging.getLogger("bot")
+
+# с этого момента считаются время старта и время до первого апдейта
+STARTED_AT = time.monotonic()
+
+# Клиент OpenAI создаётся при первой проверке адреса: пакет openai тяжёлый,
+# а без OPENAI_API_KEY он не нужен вовсе. После старта он подгружается в фоне.
+_openai_client = None
+
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        if not OPENAI_API_KEY:
+            raise RuntimeError("OPENAI_API_KEY не задан")
+        from openai import AsyncOpenAI
+        _openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=AI_TIMEOUT, max_retries=0)
+    return _openai_client
 
 # ================== THREADS ==================
+# Встроенный список магазинов: используется, пока нет файла SHOPS_PATH.
 
-ALLOWED_THREADS = {
+DEFAULT_THREADS = {
     -1002079167705: 7340,
     -1002936236597: 4,
     -1002423500927: 4,
@@ -43,7 +162,7 @@ ALLOWED_THREADS = {
     -1002538985387: 4,
 }
 
-CHAT_NAMES = {
+DEFAULT_CHAT_NAMES = {
     -1002079167705: "A. Mousse Art Bakery - Белинского, 23",
     -1002936236597: "B. Millionroz.by - Тимирязева, 67",
     -1002423500927: "E. Flovi.Studio - Тимирязева, 65Б",
@@ -57,20 +176,821 @@ CHAT_NAMES = {
     -1002538985387: "L. Lamour.by - Кропоткина, 84",
 }
 
-bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=API_TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
 
-message_counter = {"date": None, "count": 0}
+# ================== МАГАЗИНЫ ==================
+# Настройки магазинов собираются в неизменяемую таблицу chat_id -> Shop,
+# которая целиком подменяется при перезагрузке; хендлеры получают свой
+# магазин одним поиском в фильтре shop_chat. Формат SHOPS_PATH — список:
+# [{"chat_id": -100..., "thread_id": 4, "name": "...", "night_start": "21:55",
+#   "night_end": "09:05", "min_length": 50}]; необязательные поля — по умолчанию.
+
+SHOP_NIGHT_START = "21:55"
+SHOP_NIGHT_END = "09:05"
+SHOP_MIN_LENGTH = 50
+
+class Shop(NamedTuple):
+    chat_id: int
+    thread_id: int | None
+    name: str
+    night_start: dtime
+    night_end: dtime
+    min_length: int
+
+    def is_night(self, now: dtime) -> bool:
+        if self.night_start > self.night_end:
+            return now >= self.night_start or now < self.night_end
+        return self.night_start <= now < self.night_end
+
+    @property
+    def hours(self) -> str:
+        return f"{self.night_end:%H:%M} - {self.night_start:%H:%M}"
+
+def parse_shop(item: dict) -> Shop:
+    return Shop(
+        chat_id=int(item["chat_id"]),
+        thread_id=int(item["thread_id"]) if item.get("thread_id") is not None else None,
+        name=str(item.get("name") or "Чат"),
+        night_start=dtime.fromisoformat(item.get("night_start", SHOP_NIGHT_START)),
+        night_end=dtime.fromisoformat(item.get("night_end", SHOP_NIGHT_END)),
+        min_length=int(item.get("min_length", SHOP_MIN_LENGTH)),
+    )
+
+def compile_shops(items: list[dict]) -> MappingProxyType:
+    """Собирает таблицу магазинов; ошибка в любой записи — исключение, таблица не меняется."""
+    shops = {}
+    for item in items:
+        shop = parse_shop(item)
+        if shop.chat_id in shops:
+            raise ValueError(f"чат {shop.chat_id} указан дважды")
+        shops[shop.chat_id] = shop
+    return MappingProxyType(shops)
+
+class ShopConfig:
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime: float | None = None
+        self.shops = compile_shops(
+            {"chat_id": chat_id, "thread_id": thread_id, "name": DEFAULT_CHAT_NAMES.get(chat_id, "Чат")}
+            for chat_id, thread_id in DEFAULT_THREADS.items()
+        )
+
+    def get(self, chat_id: int) -> Shop | None:
+        return self.shops.get(chat_id)
 
-# admin_msg_id -> data
-assign_mapping: dict[int, dict] = {}
+    def reload(self, force: bool = False) -> str | None:
+        """Перечитывает файл, если он изменился. Возвращает описание результата или None, если менять нечего."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return None
+        if mtime == self.mtime and not force:
+            return None
+        self.mtime = mtime
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                shops = compile_shops(json.load(f))
+        except Exception as e:
+            log.error("Список магазинов %s не загружен: %s", self.path, e)
+            metrics.inc("bot_shops_reloads_total", outcome="error")
+            return f"Ошибка в {self.path}: {e}. Оставлен прежний список ({len(self.shops)})."
+        added = shops.keys() - self.shops.keys()
+        removed = self.shops.keys() - shops.keys()
+        # подмена одной ссылкой: апдейт видит либо старую, либо новую таблицу целиком
+        self.shops = shops
+        log.info("Список магазинов загружен: %d (+%d, -%d)", len(shops), len(added), len(removed))
+        metrics.inc("bot_shops_reloads_total", outcome="ok")
+        return f"Магазинов: {len(shops)} (добавлено {len(added)}, убрано {len(removed)})."
+
+    async def watch(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.reload()
+
+shop_config = ShopConfig(SHOPS_PATH)
+
+def shop_chat(event: Message) -> dict | bool:
+    """Фильтр: чат магазина; передаёт хендлеру shop."""
+    shop = shop_config.get(event.chat.id)
+    return {"shop": shop} if shop else False
+
+# ================== МЕТРИКИ ==================
+# Счётчики и гистограммы задержек по этапам: хендлеры, проверка адреса ИИ,
+# исходящие запросы к Telegram, задержка event loop. Отдаются в формате
+# Prometheus на /metrics (METRICS_PORT) и кратко — командой /stats.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metrics:
+    def __init__(self):
+        self.started_at = time.time()
+        # (имя, метки) -> значение
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.gauges: dict[tuple[str, tuple], float] = {}
+        # (имя, метки) -> [счётчики по корзинам..., сумма, количество]
+        self.histograms: dict[tuple[str, tuple], list[float]] = {}
+        # функции, обновляющие gauge перед выдачей метрик
+        self.collectors: list = []
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple[str, tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+                break
+        hist[-2] += value
+        hist[-1] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Замеряет время блока; метка outcome — ok или error."""
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except BaseException:
+            outcome = "error"
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, outcome=outcome, **labels)
+
+    def quantile(self, name: str, q: float, **labels) -> float | None:
+        """Приблизительный квантиль (верхняя граница корзины) по всем гистограммам name с метками labels."""
+        merged = [0] * (len(LATENCY_BUCKETS) + 2)
+        wanted = set(self._key(name, labels)[1])
+        for (hist_name, hist_labels), hist in self.histograms.items():
+            if hist_name == name and wanted <= set(hist_labels):
+                merged = [a + b for a, b in zip(merged, hist)]
+        count = merged[-1]
+        if not count:
+            return None
+        seen = 0
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            seen += merged[i]
+            if seen >= q * count:
+                return bound
+        return float("inf")
+
+    def total(self, name: str, **labels) -> float:
+        wanted = set(self._key(name, labels)[1])
+        return sum(v for (n, l), v in self.counters.items() if n == name and wanted <= set(l))
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus."""
+        for collect in self.collectors:
+            collect()
+
+        def fmt(labels: tuple, extra: tuple = ()) -> str:
+            pairs = labels + extra
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+            for name in sorted({n for n, _ in series}):
+                lines.append(f"# TYPE {name} {kind}")
+                for (n, labels), value in series.items():
+                    if n == name:
+                        lines.append(f"{name}{fmt(labels)} {value}")
+        for name in sorted({n for n, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), hist in self.histograms.items():
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, hist):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_bucket{fmt(labels, (('le', '+Inf'),))} {hist[-1]}")
+                lines.append(f"{name}_sum{fmt(labels)} {hist[-2]}")
+                lines.append(f"{name}_count{fmt(labels)} {hist[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# ================== ХРАНИЛИЩЕ ЗАЯВОК ==================
+# Каждая заявка — компактная запись (__slots__) с двумя индексами:
+# по id карточки у исполнителя (кнопки, ответы) и по (chat_id, message_id)
+# исходного сообщения (правки). Закрытые заявки (отклонённые; выполненные
+# удаляются сразу) вытесняются по возрасту и удаляются из базы. При
+# переполнении из памяти уходят сначала закрытые, затем самые старые
+# открытые — эти остаются в базе и читаются оттуда при следующем обращении.
+
+# статусы, после которых по заявке больше ничего не ждут; принятая заявка
+# и заявка на доработке открыты до «✅ ВЫПОЛНЕН»
+CLOSED_STATUSES = frozenset({"rejected"})
+
+class OrderRecord:
+    __slots__ = (
+        "card_id",
+        "orig_chat_id",
+        "orig_msg_id",
+        "accept_reply_id",
+        "address_incomplete",
+        "original_text",
+        "edit_notification_id",
+        "edit_notice_id",
+        "edit_pending",
+        "acked_text",
+        "request_number",
+        "chat_name",
+        "driver_chat_id",
+        "driver_msg_id",
+        "driver_label",
+        "status",
+        "created_at",
+        "closed_at",
+    )
+
+    def __init__(
+        self,
+        card_id: int,
+        orig_chat_id: int,
+        orig_msg_id: int,
+        original_text: str,
+        request_number: str,
+        chat_name: str,
+        address_incomplete: bool = False,
+    ):
+        self.card_id = card_id
+        self.orig_chat_id = orig_chat_id
+        self.orig_msg_id = orig_msg_id
+        self.accept_reply_id: int | None = None
+        self.address_incomplete = address_incomplete
+        self.original_text = original_text
+        self.edit_notification_id: int | None = None
+        # сообщение о правках в чате магазина, ожидают ли правки принятия,
+        # и текст, последним принятый Исполнителем
+        self.edit_notice_id: int | None = None
+        self.edit_pending = False
+        self.acked_text: str | None = original_text
+        self.request_number = request_number
+        self.chat_name = chat_name
+        self.driver_chat_id: int | None = None
+        self.driver_msg_id: int | None = None
+        self.driver_label: str | None = None
+        self.status = "new"
+        self.created_at = time.time()
+        self.closed_at: float | None = None
+
+    @property
+    def closed(self) -> bool:
+        return self.status in CLOSED_STATUSES
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "OrderRecord":
+        record = cls.__new__(cls)
+        for name in cls.__slots__:
+            setattr(record, name, data.get(name))
+        return record
+
+class OrderStore:
+    def __init__(self, max_size: int, closed_ttl: float):
+        self.max_size = max_size
+        self.closed_ttl = closed_ttl
+        self._by_card: dict[int, OrderRecord] = {}
+        self._by_origin: dict[tuple[int, int], OrderRecord] = {}
+        # card_id закрытых заявок в порядке закрытия — для вытеснения по возрасту
+        self._closed: OrderedDict[int, None] = OrderedDict()
+        # вызываются при изменении/удалении заявки (сохранение в базу)
+        self.on_save = None
+        self.on_delete = None
+        # чтение из базы открытой заявки, вытесненной из памяти: по card_id
+        # и по (chat_id, message_id) исходного сообщения
+        self.on_load = None
+        self.on_find = None
+
+    def __len__(self) -> int:
+        return len(self._by_card)
+
+    def __iter__(self):
+        return iter(list(self._by_card.values()))
+
+    def add(self, record: OrderRecord, save: bool = True):
+        self._by_card[record.card_id] = record
+        self._by_origin[(record.orig_chat_id, record.orig_msg_id)] = record
+        if record.closed:
+            if record.closed_at is None:
+                record.closed_at = time.time()
+            self._closed[record.card_id] = None
+        if save:
+            self.save(record)
+        self.evict()
+
+    def save(self, record: OrderRecord):
+        """Сообщает хранилищу, что запись изменилась."""
+        if self.on_save:
+            self.on_save(record)
+
+    def get(self, card_id: int) -> OrderRecord | None:
+        record = self._by_card.get(card_id)
+        if record is None and self.on_load:
+            record = self._restore(self.on_load(card_id))
+        return record
+
+    def find_by_origin(self, chat_id: int, message_id: int) -> OrderRecord | None:
+        record = self._by_origin.get((chat_id, message_id))
+        if record is None and self.on_find:
+            card_id = self.on_find(chat_id, message_id)
+            if card_id is not None and self.on_load:
+                record = self._restore(self.on_load(card_id))
+        return record
+
+    def _restore(self, record: OrderRecord | None) -> OrderRecord | None:
+        if record is not None:
+            self.add(record, save=False)
+        return record
+
+    def set_status(self, record: OrderRecord, status: str):
+        """Решение по заявке; закрывает её только статус из CLOSED_STATUSES,
+        смена решения на другое снова открывает."""
+        record.status = status
+        if record.closed:
+            if record.card_id not in self._closed:
+                record.closed_at = time.time()
+                self._closed[record.card_id] = None
+        else:
+            record.closed_at = None
+            self._closed.pop(record.card_id, None)
+        self.save(record)
+
+    def remove(self, card_id: int, delete: bool = True) -> OrderRecord | None:
+        """Убирает заявку из памяти; delete=False — запись в базе остаётся."""
+        record = self._by_card.pop(card_id, None)
+        if record is not None:
+            self._by_origin.pop((record.orig_chat_id, record.orig_msg_id), None)
+            self._closed.pop(card_id, None)
+            if delete and self.on_delete:
+                self.on_delete(card_id)
+        return record
+
+    def evict(self) -> list[OrderRecord]:
+        """Удаляет просроченные закрытые заявки и лишние сверх max_size."""
+        evicted = []
+        deadline = time.time() - self.closed_ttl
+        while self._closed:
+            card_id = next(iter(self._closed))
+            if self._by_card[card_id].closed_at > deadline:
+                break
+            evicted.append(self.remove(card_id))
+
+        while len(self._by_card) > self.max_size:
+            # сначала самые старые закрытые; открытые уходят только из памяти
+            if self._closed:
+                evicted.append(self.remove(next(iter(self._closed))))
+            else:
+                evicted.append(self.remove(next(iter(self._by_card)), delete=False))
+        return evicted
+
+    def memory_usage(self) -> int:
+        """Приблизительный объём памяти (байт), занятый заявками и индексами."""
+        total = sys.getsizeof(self._by_card) + sys.getsizeof(self._by_origin) + sys.getsizeof(self._closed)
+        for record in self._by_card.values():
+            total += sys.getsizeof(record) + sys.getsizeof(record.original_text)
+            if record.acked_text is not record.original_text:
+                total += sys.getsizeof(record.acked_text)
+            total += sys.getsizeof(record.request_number) + sys.getsizeof(record.chat_name)
+        return total
+
+    def stats(self) -> dict:
+        return {
+            "orders": len(self._by_card),
+            "closed": len(self._closed),
+            "memory_bytes": self.memory_usage(),
+        }
+
+orders = OrderStore(max_size=ORDER_STORE_MAX, closed_ttl=ORDER_CLOSED_TTL)
 
 # username (без @, lowercase) -> chat_id, заполняется автоматически
 # при любом приватном сообщении пользователя боту (например /start)
 known_users: dict[str, int] = {}
 
+# ================== ХРАНЕНИЕ СОСТОЯНИЯ (SQLite) ==================
+# Заявки, счётчик номеров, автопилот и известные пользователи переживают
+# передеплой. База в режиме WAL; изменения копятся в памяти и пишутся одной
+# транзакцией раз в DB_FLUSH_INTERVAL, чтобы хендлеры не ждали диска.
+# Счётчик номеров увеличивается сразу, в отдельной транзакции, и номер
+# закрепляется за исходным сообщением: повтор апдейта получает тот же номер.
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    card_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    date TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS autopilot (
+    chat_id INTEGER PRIMARY KEY,
+    enabled INTEGER NOT NULL,
+    thread_id INTEGER,
+    until REAL
+);
+CREATE TABLE IF NOT EXISTS known_users (
+    username TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timers (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    due REAL NOT NULL,
+    payload TEXT NOT NULL,
+    shard INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS night_orders (
+    chat_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chat_id, msg_id)
+);
+CREATE TABLE IF NOT EXISTS order_history (
+    card_id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    request_number TEXT,
+    chat_name TEXT,
+    status TEXT,
+    created_at REAL NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS order_history_created ON order_history (created_at);
+CREATE INDEX IF NOT EXISTS order_history_origin ON order_history (chat_id, msg_id);
+CREATE TABLE IF NOT EXISTS order_terms (
+    term TEXT NOT NULL,
+    card_id INTEGER NOT NULL,
+    PRIMARY KEY (term, card_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS order_terms_card ON order_terms (card_id);
+CREATE TABLE IF NOT EXISTS shop_stats (
+    date TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (date, chat_id, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS order_index (
+    card_id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS request_numbers (
+    chat_id INTEGER NOT NULL,
+    msg_id INTEGER NOT NULL,
+    number TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, msg_id)
+) WITHOUT ROWID;
+"""
+
+def shard_of(chat_id: int) -> int:
+    """Шард, которому принадлежит чат (и все заявки из него)."""
+    return chat_id % SHARDS
+
+def is_own_chat(chat_id: int) -> bool:
+    return SHARD_INDEX is None or shard_of(chat_id) == SHARD_INDEX
+
+# /find: сколько совпадений терма считать «редким» запросом (см. Storage.search_history)
+HISTORY_SCAN_CAP = 500
+
+class Storage:
+    def __init__(self, path: str, flush_interval: float):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.flush_interval = flush_interval
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.executescript(DB_SCHEMA)
+        self._migrate()
+        # ключ -> (sql, параметры); повторная запись того же ключа заменяет предыдущую
+        self._pending: dict[tuple, tuple[str, tuple]] = {}
+
+    def _migrate(self):
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(timers)")}
+        if "shard" not in columns:
+            self.db.execute("ALTER TABLE timers ADD COLUMN shard INTEGER NOT NULL DEFAULT 0")
+
+    def queue(self, key: tuple, sql: str, params: tuple):
+        self._pending[key] = (sql, params)
+
+    def flush(self):
+        """Записывает накопленные изменения одной транзакцией."""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            # IMMEDIATE: при шардах в базу пишут несколько процессов, ждём блокировку сразу
+            self.db.execute("BEGIN IMMEDIATE")
+            for sql, params in batch.values():
+                # список параметров — несколько строк одним запросом
+                if isinstance(params, list):
+                    self.db.executemany(sql, params)
+                else:
+                    self.db.execute(sql, params)
+            self.db.execute("COMMIT")
+        except Exception:
+            if self.db.in_transaction:
+                self.db.execute("ROLLBACK")
+            # пачка возвращается в очередь и запишется следующим flush; ключи,
+            # поставленные заново за это время, новее и остаются как есть
+            batch.update(self._pending)
+            self._pending = batch
+            raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Не удалось записать состояние в базу")
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    # --- заявки ---
+
+    def save_order(self, record: OrderRecord):
+        self.queue(
+            ("order", record.card_id),
+            "INSERT OR REPLACE INTO orders (card_id, data) VALUES (?, ?)",
+            (record.card_id, json.dumps(record.to_dict(), ensure_ascii=False)),
+        )
+        self.save_history(record)
+
+    def delete_order(self, card_id: int):
+        self.queue(("order", card_id), "DELETE FROM orders WHERE card_id = ?", (card_id,))
+        self.queue(("order_index", card_id), "DELETE FROM order_index WHERE card_id = ?", (card_id,))
+
+    def load_order(self, card_id: int) -> OrderRecord | None:
+        # незаписанное изменение новее базы: удалённая заявка не должна вернуться
+        pending = self._pending.get(("order", card_id))
+        if pending:
+            sql, params = pending
+            return OrderRecord.from_dict(json.loads(params[1])) if sql.startswith("INSERT") else None
+        row = self.db.execute("SELECT data FROM orders WHERE card_id = ?", (card_id,)).fetchone()
+        return OrderRecord.from_dict(json.loads(row[0])) if row else None
+
+    def order_card(self, chat_id: int, msg_id: int) -> int | None:
+        """card_id заявки по исходному сообщению (по истории, в ней есть все заявки)."""
+        row = self.db.execute(
+            "SELECT card_id FROM order_history WHERE chat_id = ? AND msg_id = ? ORDER BY card_id DESC LIMIT 1",
+            (chat_id, msg_id),
+        ).fetchone()
+        return row[0] if row else None
+
+    def load_orders(self) -> list[OrderRecord]:
+        rows = self.db.execute("SELECT data FROM orders ORDER BY card_id").fetchall()
+        records = (OrderRecord.from_dict(json.loads(data)) for (data,) in rows)
+        return [record for record in records if is_own_chat(record.orig_chat_id)]
+
+    def index_order(self, card_id: int, chat_id: int):
+        """Пишет владельца карточки сразу, без отложенной записи: по нему главный
+        процесс отправляет нажатия кнопок нужному шарду."""
+        self.db.execute(
+            "INSERT OR REPLACE INTO order_index (card_id, chat_id) VALUES (?, ?)",
+            (card_id, chat_id),
+        )
+
+    def order_chat(self, card_id: int) -> int | None:
+        row = self.db.execute("SELECT chat_id FROM order_index WHERE card_id = ?", (card_id,)).fetchone()
+        return row[0] if row else None
+
+    # --- история заявок и поисковый индекс ---
+    # В отличие от orders, история не чистится: закрытые заявки уходят из
+    # памяти и из orders, но остаются доступны для /find.
+
+    def save_history(self, record: OrderRecord):
+        card_id = record.card_id
+        self.queue(
+            ("history", card_id),
+            "INSERT OR REPLACE INTO order_history "
+            "(card_id, chat_id, msg_id, request_number, chat_name, status, created_at, text) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (card_id, record.orig_chat_id, record.orig_msg_id, record.request_number,
+             record.chat_name, record.status, record.created_at, record.original_text),
+        )
+        # термы пересобираются целиком: удаление идёт в пачке раньше вставки
+        self.queue(("terms_delete", card_id), "DELETE FROM order_terms WHERE card_id = ?", (card_id,))
+        self.queue(
+            ("terms", card_id),
+            "INSERT OR IGNORE INTO order_terms (term, card_id) VALUES (?, ?)",
+            [(term, card_id) for term in order_terms(record)],
+        )
+
+    def set_history_status(self, card_id: int, status: str):
+        self.queue(
+            ("history_status", card_id),
+            "UPDATE order_history SET status = ? WHERE card_id = ?",
+            (status, card_id),
+        )
+
+    def missing_history(self, card_ids: list[int]) -> set[int]:
+        # проверяются только переданные заявки: сама история растёт без ограничений
+        known = set()
+        for i in range(0, len(card_ids), 500):
+            chunk = card_ids[i:i + 500]
+            known.update(row[0] for row in self.db.execute(
+                f"SELECT card_id FROM order_history WHERE card_id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ))
+        return set(card_ids) - known
+
+    def search_history(self, groups: list[list[str]], limit: int) -> list[tuple]:
+        """Заявки, у которых в каждой группе совпал хотя бы один префикс терма; новые сначала."""
+        def ranges(prefixes: list[str]) -> tuple[str, list[str]]:
+            # диапазон [prefix, prefix + максимальный символ) — поиск по префиксу по индексу
+            sql = " OR ".join("(term >= ? AND term < ?)" for _ in prefixes)
+            return sql, [bound for prefix in prefixes for bound in (prefix, prefix + "\uffff")]
+
+        # самая редкая группа (считаем до HISTORY_SCAN_CAP) задаёт кандидатов, остальные
+        # проверяются по заявке; если редких нет, идём по истории от новых, пока не наберём limit
+        counted = []
+        for prefixes in groups:
+            sql, params = ranges(prefixes)
+            (count,) = self.db.execute(
+                f"SELECT count(*) FROM (SELECT 1 FROM order_terms WHERE {sql} LIMIT ?)",
+                (*params, HISTORY_SCAN_CAP),
+            ).fetchone()
+            counted.append((count, sql, params))
+        counted.sort(key=lambda item: item[0])
+
+        where, params = [], []
+        if counted[0][0] < HISTORY_SCAN_CAP:
+            _, sql, driver_params = counted.pop(0)
+            where.append(f"card_id IN (SELECT card_id FROM order_terms WHERE {sql})")
+            params += driver_params
+        for _, sql, group_params in counted:
+            where.append(f"EXISTS (SELECT 1 FROM order_terms t WHERE t.card_id = h.card_id AND ({sql}))")
+            params += group_params
+        return self.db.execute(
+            "SELECT card_id, chat_id, msg_id, request_number, chat_name, status, created_at, text "
+            "FROM order_history h WHERE " + " AND ".join(where) + " ORDER BY created_at DESC LIMIT ?",
+            (*params, limit),
+        ).fetchall()
+
+    # --- счётчик номеров заявок ---
+
+    def next_request_number(self, date: str, chat_id: int, msg_id: int) -> str:
+        """Номер заявки для сообщения магазина. Первый раз счётчик за день атомарно
+        увеличивается; повторная обработка того же сообщения получает прежний номер."""
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute(
+                "SELECT number FROM request_numbers WHERE chat_id = ? AND msg_id = ?",
+                (chat_id, msg_id),
+            ).fetchone()
+            if row:
+                number = row[0]
+            else:
+                self.db.execute(
+                    "INSERT INTO counters (date, count) VALUES (?, 1) "
+                    "ON CONFLICT(date) DO UPDATE SET count = count + 1",
+                    (date,),
+                )
+                (count,) = self.db.execute("SELECT count FROM counters WHERE date = ?", (date,)).fetchone()
+                number = f"{count:02d} / {date}"
+                self.db.execute(
+                    "INSERT INTO request_numbers (chat_id, msg_id, number, created_at) VALUES (?, ?, ?, ?)",
+                    (chat_id, msg_id, number, time.time()),
+                )
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return number
+
+    def prune_request_numbers(self, before: float):
+        # апдейт повторяется только после перезапуска, старые номера не нужны
+        self.db.execute("DELETE FROM request_numbers WHERE created_at < ?", (before,))
+
+    # --- автопилот ---
+
+    def save_autopilot(self, chat_id: int, enabled: bool, thread_id: int | None, until: float | None):
+        self.queue(
+            ("autopilot", chat_id),
+            "INSERT OR REPLACE INTO autopilot (chat_id, enabled, thread_id, until) VALUES (?, ?, ?, ?)",
+            (chat_id, int(enabled), thread_id, until),
+        )
+
+    def load_autopilot(self) -> list[tuple[int, bool, int | None, float | None]]:
+        rows = self.db.execute("SELECT chat_id, enabled, thread_id, until FROM autopilot").fetchall()
+        return [
+            (chat_id, bool(enabled), thread_id, until)
+            for chat_id, enabled, thread_id, until in rows
+            if is_own_chat(chat_id)
+        ]
+
+    # --- известные пользователи ---
+
+    def save_known_user(self, username: str, chat_id: int):
+        self.queue(
+            ("known_user", username),
+            "INSERT OR REPLACE INTO known_users (username, chat_id) VALUES (?, ?)",
+            (username, chat_id),
+        )
+
+    def load_known_users(self) -> dict[str, int]:
+        return dict(self.db.execute("SELECT username, chat_id FROM known_users").fetchall())
+
+    # --- статистика по магазинам ---
+
+    def save_stat(self, date: str, chat_id: int, name: str, value):
+        self.queue(
+            ("stat", date, chat_id, name),
+            "INSERT OR REPLACE INTO shop_stats (date, chat_id, name, value) VALUES (?, ?, ?, ?)",
+            (date, chat_id, name, json.dumps(value)),
+        )
+
+    def load_stat(self, date: str, chat_id: int, name: str, default=None):
+        # незаписанное значение новее базы
+        pending = self._pending.get(("stat", date, chat_id, name))
+        if pending:
+            return json.loads(pending[1][3])
+        row = self.db.execute(
+            "SELECT value FROM shop_stats WHERE date = ? AND chat_id = ? AND name = ?",
+            (date, chat_id, name),
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def load_stats(self, date: str) -> dict[int, dict]:
+        stats: dict[int, dict] = {}
+        rows = self.db.execute("SELECT chat_id, name, value FROM shop_stats WHERE date = ?", (date,))
+        for chat_id, name, value in rows:
+            stats.setdefault(chat_id, {})[name] = json.loads(value)
+        return stats
+
+    # --- ночная очередь ---
+
+    def save_night_order(self, held: "HeldOrder"):
+        self.queue(
+            ("night_order", held.chat_id, held.msg_id),
+            "INSERT OR REPLACE INTO night_orders (chat_id, msg_id, data) VALUES (?, ?, ?)",
+            (held.chat_id, held.msg_id, json.dumps(held.to_dict(), ensure_ascii=False)),
+        )
+
+    def delete_night_order(self, chat_id: int, msg_id: int):
+        self.queue(
+            ("night_order", chat_id, msg_id),
+            "DELETE FROM night_orders WHERE chat_id = ? AND msg_id = ?",
+            (chat_id, msg_id),
+        )
+
+    def load_night_orders(self) -> list["HeldOrder"]:
+        rows = self.db.execute("SELECT chat_id, data FROM night_orders").fetchall()
+        return [HeldOrder.from_dict(json.loads(data)) for chat_id, data in rows if is_own_chat(chat_id)]
+
+    # --- отложенные действия ---
+
+    def save_timer(self, key: str, kind: str, due: float, payload: dict):
+        self.queue(
+            ("timer", key),
+            "INSERT OR REPLACE INTO timers (key, kind, due, payload, shard) VALUES (?, ?, ?, ?, ?)",
+            (key, kind, due, json.dumps(payload, ensure_ascii=False), SHARD_INDEX or 0),
+        )
+
+    def delete_timer(self, key: str):
+        self.queue(("timer", key), "DELETE FROM timers WHERE key = ?", (key,))
+
+    def load_timers(self) -> list[tuple[str, str, float, dict]]:
+        # задачи шардов, которых больше нет (SHARDS уменьшили), забирает шард 0
+        shard = SHARD_INDEX or 0
+        rows = self.db.execute(
+            "SELECT key, kind, due, payload FROM timers "
+            "WHERE shard = ? OR (? = 0 AND shard >= ?) ORDER BY due",
+            (shard, shard, SHARDS),
+        ).fetchall()
+        return [(key, kind, due, json.loads(payload)) for key, kind, due, payload in rows]
+
+storage = Storage(DB_PATH, flush_interval=DB_FLUSH_INTERVAL)
+orders.on_save = storage.save_order
+orders.on_delete = storage.delete_order
+orders.on_load = storage.load_order
+orders.on_find = storage.order_card
+
 # ================== АВТОПИЛОТ ==================
-# chat_id -> {"enabled": bool, "task": asyncio.Task | None}
+# chat_id -> {"enabled": bool}; выключение по времени — задача планировщика "autopilot:<chat_id>"
 autopilot_state: dict[int, dict] = {}
 
 def is_autopilot_active(chat_id: int) -> bool:
@@ -100,40 +1020,946 @@ ADDRESS_AI_PROMPT = """
 }
 """
 
-def check_address_with_ai(text: str) -> dict:
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": ADDRESS_AI_PROMPT},
-            {"role": "user", "content": text}
-        ],
-        temperature=0
-    )
+# Ограничивает число одновременных запросов к OpenAI: при утреннем потоке
+# заявок проверки идут параллельно, но не больше AI_CONCURRENCY штук сразу.
+ai_semaphore = asyncio.Semaphore(AI_CONCURRENCY)
+
+async def check_address_with_ai(text: str) -> dict:
+    """Асинхронно проверяет адрес через ИИ, не блокируя event loop."""
+    async with ai_semaphore:
+        with metrics.timer("bot_ai_check_seconds", mode="single"):
+            response = await asyncio.wait_for(
+                get_openai_client().chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": ADDRESS_AI_PROMPT},
+                        {"role": "user", "content": text}
+                    ],
+                    temperature=0
+                ),
+                timeout=AI_TIMEOUT,
+            )
     return json.loads(response.choices[0].message.content)
 
+# ================== ПАЧКИ ПРОВЕРОК АДРЕСА ==================
+# В пиковый поток заявки, пришедшие в пределах AI_BATCH_WINDOW, проверяются
+# одним запросом: системный промпт передаётся один раз, ответ — массив
+# вердиктов по id заявки. Если пачка не удалась или ответ не разобрался,
+# заявки из неё проверяются по одной.
+
+ADDRESS_AI_BATCH_PROMPT = """
+Ты помощник службы доставки.
+
+Тебе придёт JSON-массив заявок: [{"id": "...", "text": "..."}].
+Для КАЖДОЙ заявки проверь, содержит ли текст следующие данные:
+- street (улица)
+- house (номер дома)
+- entrance (подъезд)
+- floor (этаж)
+- apartment (квартира)
+
+Верни СТРОГО JSON:
+{
+  "results": [
+    {
+      "id": "id заявки",
+      "street": true/false,
+      "house": true/false,
+      "entrance": true/false,
+      "floor": true/false,
+      "apartment": true/false,
+      "comment": "кратко, что отсутствует"
+    }
+  ]
+}
+"""
+
+ADDRESS_FIELDS = ("street", "house", "entrance", "floor", "apartment")
+
+async def check_addresses_batch_with_ai(items: list[tuple[str, str]]) -> dict[str, dict]:
+    """Проверяет несколько заявок одним запросом. items — [(id, text)], результат — {id: вердикт}."""
+    payload = json.dumps([{"id": item_id, "text": text} for item_id, text in items], ensure_ascii=False)
+    async with ai_semaphore:
+        with metrics.timer("bot_ai_check_seconds", mode="batch"):
+            response = await asyncio.wait_for(
+                get_openai_client().chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": ADDRESS_AI_BATCH_PROMPT},
+                        {"role": "user", "content": payload}
+                    ],
+                    temperature=0,
+                    response_format={"type": "json_object"},
+                ),
+                timeout=AI_TIMEOUT,
+            )
+    results = json.loads(response.choices[0].message.content)["results"]
+    verdicts = {}
+    for item in results:
+        if not isinstance(item, dict):
+            continue
+        verdict = {field: item.get(field) for field in ADDRESS_FIELDS}
+        if all(isinstance(value, bool) for value in verdict.values()):
+            verdict["comment"] = str(item.get("comment") or "")
+            verdicts[str(item.get("id"))] = verdict
+    return verdicts
+
+class AddressBatcher:
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._pending: list[tuple[str, str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self._seq = 0
+
+    async def check(self, text: str) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        self._pending.append((str(self._seq), text, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[str, str, asyncio.Future]]):
+        verdicts = {}
+        if len(batch) > 1:
+            metrics.inc("bot_ai_batches_total")
+            metrics.inc("bot_ai_batched_orders_total", len(batch))
+            try:
+                verdicts = await check_addresses_batch_with_ai([(item_id, text) for item_id, text, _ in batch])
+            except Exception:
+                log.warning("Пачка проверок адреса не удалась, проверяю по одной", exc_info=True)
+
+        leftovers = []
+        for item_id, text, future in batch:
+            verdict = verdicts.get(item_id)
+            if verdict is None:
+                leftovers.append((text, future))
+            elif not future.done():
+                future.set_result(verdict)
+
+        if len(batch) > 1 and leftovers:
+            metrics.inc("bot_ai_batch_fallbacks_total", len(leftovers))
+        await asyncio.gather(*(self._check_one(text, future) for text, future in leftovers))
+
+    @staticmethod
+    async def _check_one(text: str, future: asyncio.Future):
+        try:
+            verdict = await check_address_with_ai(text)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(verdict)
+
+address_batcher = AddressBatcher(window=AI_BATCH_WINDOW, max_size=AI_BATCH_MAX)
+
+# ================== КЭШ ПРОВЕРОК АДРЕСА ==================
+# Магазины часто повторяют одну и ту же заявку (в том числе в разные чаты).
+# Вердикт ИИ кэшируется по нормализованному тексту: LRU + TTL, с сохранением
+# на диск, а одновременные запросы одного и того же текста ждут один вызов.
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+class AddressCache:
+    def __init__(self, path: str, max_size: int, ttl: float):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        # key -> (expires_at, verdict), порядок = порядок последнего использования
+        self._items: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._pending: dict[str, asyncio.Task] = {}
+        self._save_handle: asyncio.TimerHandle | None = None
+        self.load()
+
+    @staticmethod
+    def key(text: str) -> str:
+        normalized = _WHITESPACE_RE.sub(" ", text).strip().casefold()
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def lookup(self, text: str) -> dict | None:
+        """Вердикт из кэша без обращения к ИИ."""
+        verdict = self.get(self.key(text))
+        if verdict is None:
+            return None
+        self.hits += 1
+        return dict(verdict)
+
+    def get(self, key: str) -> dict | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, verdict = item
+        if expires_at < time.time():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return verdict
+
+    def put(self, key: str, verdict: dict):
+        self._items[key] = (time.time() + self.ttl, verdict)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        self._schedule_save()
+
+    async def get_or_compute(self, text: str, compute) -> dict:
+        """Возвращает вердикт из кэша или вычисляет его через compute() (один раз на ключ)."""
+        key = self.key(text)
+        verdict = self.get(key)
+        if verdict is not None:
+            self.hits += 1
+            return dict(verdict)
+
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.create_task(compute())
+            self._pending[key] = task
+            task.add_done_callback(lambda t: self._on_computed(key, t))
+        else:
+            self.coalesced += 1
+        # shield: отмена одного ожидающего не отменяет общий запрос к ИИ
+        return dict(await asyncio.shield(task))
+
+    def _on_computed(self, key: str, task: asyncio.Task):
+        self._pending.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "pending": len(self._pending),
+        }
+
+    # --- хранение на диске ---
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                rows = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, expires_at, verdict in rows[-self.max_size:]:
+            if expires_at > now:
+                self._items[key] = (expires_at, verdict)
+
+    def _schedule_save(self, delay: float = 5):
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(delay, self.save)
+
+    def save(self):
+        self._save_handle = None
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        rows = [[key, expires_at, verdict] for key, (expires_at, verdict) in self._items.items()]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+address_cache = AddressCache(
+    os.path.join(DATA_DIR, f"address_cache{SHARD_SUFFIX}.json"),
+    max_size=ADDRESS_CACHE_SIZE,
+    ttl=ADDRESS_CACHE_TTL,
+)
+
+# ================== ЛОКАЛЬНАЯ ПРОВЕРКА АДРЕСА ==================
+# Большинство заявок пишут адрес по шаблону «ул. …, д. …, под. …, эт. …, кв. …».
+# Такие адреса разбираются регулярками за микросекунды; ИИ вызывается только
+# если разбор не уверен (какие-то поля не найдены или записаны нестандартно).
+
+ADDRESS_RULES_CONFIDENCE = float(os.getenv("ADDRESS_RULES_CONFIDENCE", 1.0))
+
+_STREET_TYPES = (
+    r"ул|улица|пр-т|пр-кт|просп|проспект|пр|пер|переулок|б-р|бул|бульвар|"
+    r"тракт|ш|шоссе|пл|площадь|наб|набережная|мкр|микрорайон|проезд|пр-д|тупик"
+)
+_NUM = r"№?\s*\d+"
+
+ADDRESS_PATTERNS = {
+    "street": re.compile(rf"(?<![а-яё])(?:{_STREET_TYPES})\.?\s+[а-яёa-z0-9]", re.I),
+    "house": re.compile(rf"(?<![а-яё])(?:д|дом)\.?\s*{_NUM}", re.I),
+    "entrance": re.compile(rf"(?<![а-яё])(?:подъезд|под|пд|п)\.?\s*{_NUM}|\d+\s*(?:-?й\s*)?подъезд", re.I),
+    "floor": re.compile(rf"(?<![а-яё])(?:этаж|эт)\.?\s*{_NUM}|\d+\s*(?:-?й\s*)?этаж", re.I),
+    "apartment": re.compile(rf"(?<![а-яё])(?:квартира|кв|офис|оф)\.?\s*{_NUM}", re.I),
+}
+
+# «ул. Притыцкого 29» / «Тимирязева, 67»: номер дома сразу после названия улицы
+_HOUSE_AFTER_STREET_RE = re.compile(
+    rf"(?i:(?<![а-яё])({_STREET_TYPES})\.?\s+)?[А-ЯЁ][а-яё\-]+(?:\s+[А-ЯЁа-яё][а-яё\-]+)?,?\s+\d+[а-яё]?(?:\s*[/к]\s*\d+)?(?![\d:.\-])",
+)
+
+ADDRESS_FIELD_NAMES = {
+    "street": "улица",
+    "house": "дом",
+    "entrance": "подъезд",
+    "floor": "этаж",
+    "apartment": "квартира",
+}
+
+def extract_address(text: str) -> tuple[dict, float]:
+    """Разбирает адрес регулярками. Возвращает вердикт в формате ИИ и уверенность 0..1."""
+    weights = {field: float(bool(pattern.search(text))) for field, pattern in ADDRESS_PATTERNS.items()}
+
+    # дом без «д.»: после «ул./пр-т …» это надёжно, после голого названия — не очень
+    if not weights["house"]:
+        match = _HOUSE_AFTER_STREET_RE.search(text)
+        if match and match.group(1):
+            weights["house"] = 1.0
+        elif match:
+            weights["house"] = 0.5
+            weights["street"] = weights["street"] or 0.5
+
+    verdict = {field: weight > 0 for field, weight in weights.items()}
+    confidence = sum(weights.values()) / len(weights)
+
+    missing = [ADDRESS_FIELD_NAMES[k] for k, v in verdict.items() if not v]
+    verdict["comment"] = f"Не указано: {', '.join(missing)}" if missing else ""
+    return verdict, confidence
+
+# ================== ПРЕДОХРАНИТЕЛЬ ИИ ==================
+# Пока OpenAI тормозит или недоступен, заявки не ждут его таймаута:
+# при высокой доле ошибок предохранитель размыкается, и адрес проверяется
+# только локальным разбором. Через AI_BREAKER_COOLDOWN одна заявка
+# пробует ИИ снова (half-open): успех — ИИ возвращается, ошибка — ждём ещё.
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    def __init__(self, window: int, min_calls: int, error_rate: float, cooldown: float, on_change=None):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.on_change = on_change
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._results: deque[bool] = deque(maxlen=window)
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Можно ли сейчас обращаться к ИИ."""
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self._set_state(self.HALF_OPEN)
+        if self.state == self.OPEN:
+            return False
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record(self, ok: bool):
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+            self._set_state(self.CLOSED if ok else self.OPEN)
+            return
+        self._results.append(ok)
+        failures = self._results.count(False)
+        if (
+            self.state == self.CLOSED
+            and len(self._results) >= self.min_calls
+            and failures / len(self._results) >= self.error_rate
+        ):
+            self._set_state(self.OPEN)
+
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        previous, self.state = self.state, state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+        if state == self.CLOSED:
+            self._results.clear()
+        log.warning("Предохранитель ИИ: %s -> %s", previous, state)
+        metrics.inc("bot_ai_breaker_transitions_total", state=state)
+        if self.on_change:
+            self.on_change(previous, state)
+
+def on_ai_breaker_change(previous: str, state: str):
+    if state == CircuitBreaker.OPEN and previous == CircuitBreaker.CLOSED:
+        notify_admin("⚠️ ИИ недоступен — адреса проверяются без ИИ, карточки помечены.")
+    elif state == CircuitBreaker.CLOSED:
+        notify_admin("✅ ИИ снова доступен — проверка адресов через ИИ возобновлена.")
+
+ai_breaker = CircuitBreaker(
+    window=AI_BREAKER_WINDOW,
+    min_calls=AI_BREAKER_MIN_CALLS,
+    error_rate=AI_BREAKER_ERROR_RATE,
+    cooldown=AI_BREAKER_COOLDOWN,
+    on_change=on_ai_breaker_change,
+)
+
+async def verify_address(text: str) -> tuple[dict, str]:
+    """Проверка адреса: сначала локальный разбор, ИИ (через кэш) — только при низкой уверенности.
+    Возвращает вердикт и источник: rules, ai или fallback (ИИ недоступен, вердикт по правилам)."""
+    verdict, confidence = extract_address(text)
+    if confidence >= ADDRESS_RULES_CONFIDENCE:
+        metrics.inc("bot_address_checks_total", source="rules")
+        return verdict, "rules"
+
+    cached = address_cache.lookup(text)
+    if cached is not None:
+        metrics.inc("bot_address_checks_total", source="cache")
+        return cached, "ai"
+
+    if not OPENAI_API_KEY:
+        metrics.inc("bot_address_checks_total", source="fallback")
+        return verdict, "fallback"
+
+    if not ai_breaker.allow():
+        metrics.inc("bot_address_checks_total", source="fallback")
+        return verdict, "fallback"
+
+    metrics.inc("bot_address_checks_total", source="ai")
+    try:
+        result = await asyncio.wait_for(
+            address_cache.get_or_compute(text, lambda: address_batcher.check(text)),
+            timeout=AI_TIMEOUT_BUDGET,
+        )
+    except Exception:
+        ai_breaker.record(False)
+        metrics.inc("bot_ai_failures_total")
+        return verdict, "fallback"
+    ai_breaker.record(True)
+    return result, "ai"
+
+def chat_label(chat_id: int | None) -> str:
+    """Метка чата для метрик: личка исполнителя — admin, без чата — none."""
+    if chat_id is None:
+        return "none"
+    if chat_id == UNIQUE_USER_ID:
+        return "admin"
+    return str(chat_id)
+
+# ================== ОЧЕРЕДЬ ИСХОДЯЩИХ ==================
+# Все обращения к Telegram идут через одну очередь с token bucket'ами:
+# общий лимит бота, лимит на группу и на личный чат. Чаты обслуживаются по
+# кругу, а внутри — по приоритету: карточки исполнителю и ответы на кнопки
+# раньше информационных сообщений. TelegramRetryAfter и сетевые ошибки
+# не роняют хендлер — запрос повторяется после паузы.
+
+PRIORITY_HIGH = 0    # карточки исполнителю, ответы на кнопки
+PRIORITY_NORMAL = 1  # ответы магазину по заявке
+PRIORITY_LOW = 2     # информационные сообщения, удаление
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", 25))       # запросов/сек на бота
+TG_GROUP_RATE = float(os.getenv("TG_GROUP_RATE", 20 / 60))    # сообщений/сек в группу
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", 1))      # сообщений/сек в личный чат
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", 5))
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до следующего токена (0 — можно сейчас)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class OutboundJob:
+    __slots__ = ("chat_id", "call", "priority", "method", "future", "on_result", "enqueued_at", "attempts")
+
+    def __init__(self, chat_id: int | None, call, priority: int, method: str, future: asyncio.Future,
+                 on_result=None):
+        self.chat_id = chat_id
+        self.call = call
+        self.priority = priority
+        self.method = method
+        self.future = future
+        # вызывается с результатом, даже если вызывающий уже отменён
+        self.on_result = on_result
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class OutboundQueue:
+    def __init__(self, global_rate: float, group_rate: float, private_rate: float, max_retries: int,
+                 shares: int = 1):
+        # shares > 1: столько процессов (шардов) делят общий лимит бота и личные
+        # чаты (прежде всего чат Исполнителя) — каждому достаётся своя доля.
+        # Группа принадлежит одному шарду, её лимит не делится.
+        self.group_rate = group_rate
+        self.private_rate = private_rate / shares
+        self.private_burst = max(1.0, 3 / shares)
+        self.max_retries = max_retries
+        global_rate /= shares
+        self._global = TokenBucket(global_rate, capacity=max(1.0, global_rate))
+        self._buckets: dict[int, TokenBucket] = {}
+        # priority -> {chat_id -> очередь задач}; порядок чатов = очередь обслуживания
+        self._queues: list[OrderedDict[int | None, deque]] = [OrderedDict() for _ in range(PRIORITY_LOW + 1)]
+        self._size = 0
+        self._wakeup = asyncio.Event()
+        self._worker: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
+        # метрики
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(
+        self, chat_id: int | None, call, priority: int = PRIORITY_NORMAL, method: str = "api", on_result=None,
+    ) -> asyncio.Future:
+        """Ставит вызов API в очередь; call — функция без аргументов, возвращающая корутину.
+        chat_id=None — запрос не привязан к чату (например, ответ на кнопку).
+        Отменённый до отправки вызов не выполняется; on_result получает результат
+        уже начатого вызова, даже если вызывающий тем временем отменён."""
+        future = asyncio.get_running_loop().create_future()
+        self._push(OutboundJob(chat_id, call, priority, method, future, on_result))
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self.run())
+        return future
+
+    def _push(self, job: OutboundJob):
+        self._queues[job.priority].setdefault(job.chat_id, deque()).append(job)
+        self._size += 1
+        self._wakeup.set()
+
+    def _bucket(self, chat_id: int | None) -> TokenBucket | None:
+        if chat_id is None:
+            return None
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, capacity=3)
+            else:
+                bucket = TokenBucket(self.private_rate, capacity=self.private_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _next_job(self) -> tuple[OutboundJob | None, float | None]:
+        now = time.monotonic()
+        global_delay = self._global.delay(now)
+        if global_delay > 0:
+            return None, global_delay
+
+        min_delay = None
+        for queue in self._queues:
+            for chat_id, jobs in queue.items():
+                bucket = self._bucket(chat_id)
+                delay = bucket.delay(now) if bucket else 0.0
+                if delay > 0:
+                    min_delay = delay if min_delay is None else min(min_delay, delay)
+                    continue
+                job = jobs.popleft()
+                if jobs:
+                    queue.move_to_end(chat_id)
+                else:
+                    del queue[chat_id]
+                self._size -= 1
+                self._global.take()
+                if bucket:
+                    bucket.take()
+                return job, None
+        return None, min_delay
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            job, delay = self._next_job()
+            if job is None:
+                if delay is None:
+                    await self._wakeup.wait()
+                else:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    except asyncio.TimeoutError:
+                        pass
+                continue
+            if job.future.done():
+                # вызывающий уже не ждёт результата (отменён)
+                continue
+            task = asyncio.create_task(self._execute(job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _execute(self, job: OutboundJob):
+        started = time.monotonic()
+        if job.attempts == 0:
+            wait = started - job.enqueued_at
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            metrics.observe("bot_outbound_wait_seconds", wait, priority=job.priority)
+        chat = chat_label(job.chat_id)
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            metrics.observe("bot_telegram_call_seconds", time.monotonic() - started, method=job.method, chat=chat, outcome="retry_after")
+            self._retry(job, e, delay=e.retry_after, block=True)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            metrics.observe("bot_telegram_call_seconds", time.monotonic() - started, method=job.method, chat=chat, outcome="retry")
+            self._retry(job, e, delay=min(2 ** job.attempts, 30))
+        except Exception as e:
+            metrics.observe("bot_telegram_call_seconds", time.monotonic() - started, method=job.method, chat=chat, outcome="error")
+            self._fail(job, e)
+        else:
+            metrics.observe("bot_telegram_call_seconds", time.monotonic() - started, method=job.method, chat=chat, outcome="ok")
+            self.sent += 1
+            if job.on_result:
+                job.on_result(result)
+            if not job.future.done():
+                job.future.set_result(result)
+
+    def _retry(self, job: OutboundJob, error: Exception, delay: float, block: bool = False):
+        if job.attempts >= self.max_retries:
+            self._fail(job, error)
+            return
+        job.attempts += 1
+        self.retried += 1
+        if block:
+            # Telegram просит паузу: придерживаем весь чат (или всего бота)
+            bucket = self._bucket(job.chat_id) or self._global
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + delay)
+            self._push(job)
+        else:
+            asyncio.get_running_loop().call_later(delay, self._push, job)
+
+    async def settle(self, timeout: float):
+        """Дожидается уже начатых вызовов (не очереди): их результат может быть нужен on_result."""
+        if self._inflight:
+            await asyncio.wait(set(self._inflight), timeout=timeout)
+
+    def _fail(self, job: OutboundJob, error: Exception):
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def stats(self) -> dict:
+        started = self.sent + self.failed
+        return {
+            "depth": self._size,
+            "inflight": len(self._inflight),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "wait_avg": self.wait_total / started if started else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+outbox = OutboundQueue(
+    global_rate=TG_GLOBAL_RATE,
+    group_rate=TG_GROUP_RATE,
+    private_rate=TG_PRIVATE_RATE,
+    max_retries=TG_MAX_RETRIES,
+    shares=SHARDS,
+)
+
+def send_message(chat_id: int, text: str, *, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+    return outbox.submit(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority, "sendMessage")
+
+def reply_to(message: Message, text: str, *, priority: int = PRIORITY_NORMAL, **kwargs) -> asyncio.Future:
+    return send_message(message.chat.id, text, reply_to_message_id=message.message_id, priority=priority, **kwargs)
+
+async def edit_text(chat_id: int, message_id: int | None, text: str, *, priority: int = PRIORITY_NORMAL, **kwargs) -> bool:
+    """Редактирует текст сообщения. False — отредактировать не удалось (удалено, слишком старое и т.п.)."""
+    if not message_id:
+        return False
+    try:
+        await outbox.submit(
+            chat_id,
+            lambda: bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id, **kwargs),
+            priority,
+            "editMessageText",
+        )
+    except TelegramBadRequest:
+        return False
+    return True
+
+def answer_callback(callback: CallbackQuery, text: str | None = None, **kwargs) -> asyncio.Future:
+    return outbox.submit(None, lambda: callback.answer(text, **kwargs), PRIORITY_HIGH, "answerCallbackQuery")
+
+# ================== ДИФФ ПРАВОК ==================
+# Упорядоченный построчный дифф (difflib) для уведомлений о правках.
+# Внутри изменённых строк отмечаются изменённые слова. Общие начало и конец
+# текста отсекаются заранее, а для больших правок пословный дифф пропускается,
+# поэтому на обычной заявке дифф занимает десятки микросекунд.
+
+DIFF_WORDS_MAX_LINES = 200
+_DIFF_TOKEN_RE = re.compile(r"\S+|\s+")
+
+def _mark_words(old_line: str, new_line: str) -> tuple[str, str]:
+    """HTML обеих версий строки с выделенными (<b>) изменёнными словами."""
+    old_tokens = _DIFF_TOKEN_RE.findall(old_line)
+    new_tokens = _DIFF_TOKEN_RE.findall(new_line)
+    matcher = SequenceMatcher(None, old_tokens, new_tokens, autojunk=False)
+    if matcher.ratio() < 0.5:
+        # строка переписана целиком — выделять отдельные слова бессмысленно
+        return html.escape(old_line, quote=False), html.escape(new_line, quote=False)
+
+    old_html, new_html = [], []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        old_part = html.escape("".join(old_tokens[i1:i2]), quote=False)
+        new_part = html.escape("".join(new_tokens[j1:j2]), quote=False)
+        if tag == "equal":
+            old_html.append(old_part)
+            new_html.append(new_part)
+            continue
+        if old_part.strip():
+            old_html.append(f"<b>{old_part}</b>")
+        if new_part.strip():
+            new_html.append(f"<b>{new_part}</b>")
+    return "".join(old_html), "".join(new_html)
+
+def diff_text(old_text: str, new_text: str, word_level: bool = True) -> list[tuple[str, str, str]]:
+    """Построчный дифф в порядке текста: список (op, строка, html), op — "+" или "-"."""
+    old = old_text.splitlines()
+    new = new_text.splitlines()
+
+    # общие начало и конец не участвуют в сравнении
+    prefix = 0
+    while prefix < len(old) and prefix < len(new) and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while (
+        suffix < len(old) - prefix
+        and suffix < len(new) - prefix
+        and old[-1 - suffix] == new[-1 - suffix]
+    ):
+        suffix += 1
+    old = old[prefix:len(old) - suffix]
+    new = new[prefix:len(new) - suffix]
+
+    # большие правки: без пословного диффа и с эвристикой autojunk у SequenceMatcher
+    small = len(old) + len(new) <= DIFF_WORDS_MAX_LINES
+    word_level = word_level and small
+    result = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, old, new, autojunk=not small).get_opcodes():
+        if tag == "equal":
+            continue
+        removed = old[i1:i2]
+        added = new[j1:j2]
+        if tag == "replace" and word_level:
+            pairs = min(len(removed), len(added))
+            marked = [_mark_words(o, n) for o, n in zip(removed, added)]
+            result += [("-", line, marked[k][0]) for k, line in enumerate(removed[:pairs])]
+            result += [("-", line, html.escape(line, quote=False)) for line in removed[pairs:]]
+            result += [("+", line, marked[k][1]) for k, line in enumerate(added[:pairs])]
+            result += [("+", line, html.escape(line, quote=False)) for line in added[pairs:]]
+        else:
+            result += [("-", line, html.escape(line, quote=False)) for line in removed]
+            result += [("+", line, html.escape(line, quote=False)) for line in added]
+    # пустые строки в уведомлении не нужны
+    return [item for item in result if item[1].strip()]
+
+# ================== ПЛАНИРОВЩИК ОТЛОЖЕННЫХ ДЕЙСТВИЙ ==================
+# Все отложенные действия (удаление сообщений, выключение автопилота) лежат
+# в одной куче по времени срабатывания и хранятся в таблице timers, поэтому
+# переживают перезапуск. Один цикл спит до ближайшего срока; всё, что
+# созрело одновременно, уходит обработчику одной пачкой на вид задачи.
+# Задача с тем же ключом заменяет предыдущую, cancel(key) — отменяет.
+
+class Scheduler:
+    def __init__(self):
+        self.handlers: dict[str, object] = {}
+        self._heap: list[tuple[float, int, str]] = []
+        # key -> (kind, due, payload, seq); seq отличает актуальную запись в куче от заменённой
+        self._jobs: dict[str, tuple[str, float, dict, int]] = {}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self.fired = 0
+        self.failed = 0
+
+    def handler(self, kind: str):
+        """Декоратор: обработчик пачки созревших задач вида kind, получает список payload."""
+        def decorator(func):
+            self.handlers[kind] = func
+            return func
+        return decorator
+
+    def schedule(self, key: str, kind: str, payload: dict, *, delay: float | None = None, at: float | None = None, save: bool = True):
+        due = at if at is not None else time.time() + (delay or 0.0)
+        self._seq += 1
+        self._jobs[key] = (kind, due, payload, self._seq)
+        heapq.heappush(self._heap, (due, self._seq, key))
+        if save:
+            storage.save_timer(key, kind, due, payload)
+        if self._heap[0][1] == self._seq:
+            self._wakeup.set()
+
+    def cancel(self, key: str) -> bool:
+        # запись в куче остаётся и будет пропущена при срабатывании
+        if self._jobs.pop(key, None) is None:
+            return False
+        storage.delete_timer(key)
+        return True
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._jobs
+
+    def load(self) -> int:
+        """Восстанавливает задачи из базы; просроченные за время простоя сработают сразу."""
+        timers = storage.load_timers()
+        for key, kind, due, payload in timers:
+            self.schedule(key, kind, payload, at=due, save=False)
+        return len(timers)
+
+    def _pop_due(self, now: float) -> dict[str, list[tuple[str, dict]]]:
+        due_jobs: dict[str, list[tuple[str, dict]]] = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key = heapq.heappop(self._heap)
+            job = self._jobs.get(key)
+            if job is None or job[3] != seq:
+                continue
+            del self._jobs[key]
+            kind, _, payload, _ = job
+            due_jobs.setdefault(kind, []).append((key, payload))
+        return due_jobs
+
+    async def run(self):
+        while True:
+            now = time.time()
+            for kind, jobs in self._pop_due(now).items():
+                spawn(self._dispatch(kind, jobs))
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self, kind: str, jobs: list[tuple[str, dict]]):
+        func = self.handlers.get(kind)
+        try:
+            if func is None:
+                raise LookupError(f"нет обработчика для {kind}")
+            await func([payload for _, payload in jobs])
+            self.fired += len(jobs)
+        except Exception:
+            self.failed += len(jobs)
+            log.exception("Отложенные действия %s не выполнены (%d шт.)", kind, len(jobs))
+        # задача могла быть заново поставлена под тем же ключом, пока выполнялась
+        for key, _ in jobs:
+            if key not in self._jobs:
+                storage.delete_timer(key)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._jobs),
+            "heap": len(self._heap),
+            "fired": self.fired,
+            "failed": self.failed,
+        }
+
+scheduler = Scheduler()
+
 # ================== HELPERS ==================
 
-def get_request_number():
+# пометка в карточке, если адрес проверен без ИИ (ИИ недоступен)
+AI_FALLBACK_NOTE = "⚠️ Адрес проверен без ИИ\n\n"
+
+# фоновые задачи: держим ссылки, чтобы их не собрал сборщик мусора
+background_tasks: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def _notify_admin(text: str):
+    try:
+        await send_message(UNIQUE_USER_ID, text, priority=PRIORITY_LOW)
+    except Exception:
+        log.exception("Не удалось отправить уведомление исполнителю")
+
+def notify_admin(text: str):
+    """Служебное уведомление исполнителю в личку, без ожидания отправки."""
+    spawn(_notify_admin(text))
+
+async def _reply_shop(message: Message, text: str, priority: int, on_sent):
+    try:
+        sent = await reply_to(message, text, priority=priority)
+    except Exception:
+        log.exception("Не удалось ответить в чат %s", message.chat.id)
+        return
+    if on_sent:
+        on_sent(sent)
+
+def reply_shop(message: Message, text: str, *, priority: int = PRIORITY_NORMAL, on_sent=None):
+    """Ответ магазину без ожидания отправки: лимит на группу не задерживает
+    карточку Исполнителю. on_sent получает отправленное сообщение."""
+    spawn(_reply_shop(message, text, priority, on_sent))
+
+def get_request_number(message: Message) -> str:
     today = datetime.now(TZ).strftime("%d.%m.%Y")
-    if message_counter["date"] != today:
-        message_counter["date"] = today
-        message_counter["count"] = 0
-    message_counter["count"] += 1
-    return f"{message_counter['count']:02d} / {today}"
+    return storage.next_request_number(today, message.chat.id, message.message_id)
+
+def already_handled(message: Message) -> bool:
+    """Заявка из этого сообщения уже отправлена или ждёт в ночной очереди
+    (апдейт проигрывается повторно после перезапуска)."""
+    return bool(
+        orders.find_by_origin(message.chat.id, message.message_id)
+        or night_queue.find(message.chat.id, message.message_id)
+    )
+
+def missing_address_fields(addr: dict) -> list[str]:
+    return [k for k, v in addr.items() if v is False and k != "comment"]
+
+def is_night_time(shop: Shop) -> bool:
+    return shop.is_night(datetime.now(TZ).time())
 
-def is_night_time() -> bool:
-    now = datetime.now(TZ).time()
-    return now >= datetime.strptime("21:55", "%H:%M").time() or now < datetime.strptime("09:05", "%H:%M").time()
+# шаблоны компилируются один раз при импорте и общие для хендлеров,
+# validate_contact и поиска заявок (/find)
+ONAP_RE = re.compile(r"^/onAP(\d+)?$")
+AUTOPILOT_COMMAND_RE = re.compile(r"^/(onAP|offAP)")
+NON_DIGIT_RE = re.compile(r"\D")
+PHONE_SEPARATORS_RE = re.compile(r"[ \-\(\)]")
+PHONE_RE = re.compile(r"\+375\d{9}|80(?:25|29|33|44)\d{7}")
+LONG_NUMBER_RE = re.compile(r"\+?\d{7,}")
+USERNAME_RE = re.compile(r"@([A-Za-z0-9_]{4,32})")
+
+def extract_phones(text: str) -> list[str]:
+    """Белорусские номера из текста в виде 375XXXXXXXXX."""
+    cleaned = PHONE_SEPARATORS_RE.sub("", text)
+    return ["375" + phone[2:] if phone.startswith("80") else phone[1:] for phone in PHONE_RE.findall(cleaned)]
 
 def validate_contact(text: str) -> str:
     if not text:
         return "missing"
-    cleaned = re.sub(r"[ \-\(\)]", "", text)
-    if re.search(r"(\+375\d{9}|80(25|29|33|44)\d{7})", cleaned):
+    cleaned = PHONE_SEPARATORS_RE.sub("", text)
+    if PHONE_RE.search(cleaned):
         return "ok"
     if "@" in text:
         return "ok"
-    if re.search(r"\+?\d{7,}", cleaned):
+    if LONG_NUMBER_RE.search(cleaned):
         return "invalid"
     return "missing"
 
@@ -145,34 +1971,61 @@ def build_message_link(chat_id: int, thread_id: int | None, message_id: int) ->
         return f"https://t.me/c/{internal_id}/{thread_id}/{message_id}"
     return f"https://t.me/c/{internal_id}/{message_id}"
 
-async def delete_messages_later(chat_id: int, message_ids: list[int], delay: int = 300):
-    await asyncio.sleep(delay)
-    for m_id in message_ids:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=m_id)
-        except Exception:
-            pass
+# Telegram удаляет за один вызов deleteMessages не больше 100 сообщений
+DELETE_MESSAGES_BATCH = 100
 
-async def autopilot_timer(chat_id: int, thread_id: int | None, minutes: int):
-    """Отсчитывает заданное количество минут, затем автоматически выключает автопилот."""
-    try:
-        await asyncio.sleep(minutes * 60)
-    except asyncio.CancelledError:
-        return
+def delete_messages_later(chat_id: int, message_ids: list[int], delay: int = 300):
+    scheduler.schedule(
+        f"delete:{chat_id}:{message_ids[0]}",
+        "delete_messages",
+        {"chat_id": chat_id, "message_ids": message_ids},
+        delay=delay,
+    )
 
-    state = autopilot_state.get(chat_id)
-    if state:
-        state["enabled"] = False
-        state["task"] = None
+@scheduler.handler("delete_messages")
+async def delete_messages_batch(payloads: list[dict]):
+    """Удаляет созревшие сообщения: по чатам, пачками через deleteMessages."""
+    by_chat: dict[int, list[int]] = {}
+    for payload in payloads:
+        by_chat.setdefault(payload["chat_id"], []).extend(payload["message_ids"])
+    for chat_id, message_ids in by_chat.items():
+        for i in range(0, len(message_ids), DELETE_MESSAGES_BATCH):
+            chunk = message_ids[i:i + DELETE_MESSAGES_BATCH]
+            try:
+                await outbox.submit(
+                    chat_id,
+                    lambda chat_id=chat_id, chunk=chunk: bot.delete_messages(chat_id=chat_id, message_ids=chunk),
+                    PRIORITY_LOW,
+                    "deleteMessages",
+                )
+            except Exception:
+                pass
+
+def schedule_autopilot_off(chat_id: int, thread_id: int | None, until: float):
+    scheduler.schedule(
+        f"autopilot:{chat_id}",
+        "autopilot_off",
+        {"chat_id": chat_id, "thread_id": thread_id},
+        at=until,
+    )
 
-    try:
-        await bot.send_message(
-            chat_id,
-            "Выбран ручной режим.",
-            message_thread_id=thread_id,
-        )
-    except Exception:
-        pass
+@scheduler.handler("autopilot_off")
+async def autopilot_expired(payloads: list[dict]):
+    """Время автопилота истекло — выключаем его и сообщаем в чат."""
+    for payload in payloads:
+        chat_id, thread_id = payload["chat_id"], payload["thread_id"]
+        autopilot_state[chat_id] = {"enabled": False}
+        storage.save_autopilot(chat_id, False, thread_id, None)
+
+        try:
+            await send_message(
+                chat_id,
+                "Выбран ручной режим.",
+                message_thread_id=thread_id,
+                priority=PRIORITY_LOW,
+            )
+        except Exception:
+            pass
 
 # ================== MIDDLEWARE: ЗАПОМИНАЕМ ПОЛЬЗОВАТЕЛЕЙ ==================
 # Чтобы бот мог переслать заказ исполнителю по нику, нужно знать его chat_id.
@@ -182,119 +2035,398 @@ async def autopilot_timer(chat_id: int, thread_id: int | None, minutes: int):
 class TrackUsersMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: Message, data):
         if event.chat.type == "private" and event.from_user and event.from_user.username:
-            known_users[event.from_user.username.lower()] = event.chat.id
+            username = event.from_user.username.lower()
+            if known_users.get(username) != event.chat.id:
+                known_users[username] = event.chat.id
+                storage.save_known_user(username, event.chat.id)
         return await handler(event, data)
 
 dp.message.middleware(TrackUsersMiddleware())
 
+# ================== MIDDLEWARE: ВРЕМЯ ОБРАБОТКИ ==================
+# Замеряет каждый хендлер (метки: хендлер, чат, исход) и пишет в лог
+# апдейты, обработка которых заняла больше SLOW_UPDATE_THRESHOLD секунд.
+
+class MetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        if isinstance(event, CallbackQuery):
+            chat_id = event.message.chat.id if event.message else None
+        else:
+            chat_id = event.chat.id
+
+        start = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await handler(event, data)
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.observe("bot_handler_seconds", elapsed, handler=name, chat=chat_label(chat_id), outcome=outcome)
+            note_first_update()
+            if elapsed > SLOW_UPDATE_THRESHOLD:
+                log.warning("Медленная обработка: %s в чате %s заняла %.2f с", name, chat_id, elapsed)
+
+first_update_at: float | None = None
+
+def note_first_update():
+    global first_update_at
+    if first_update_at is None:
+        first_update_at = time.monotonic()
+        metrics.set("bot_time_to_first_update_seconds", first_update_at - STARTED_AT)
+        log.info("Первый апдейт обработан через %.2f с после запуска", first_update_at - STARTED_AT)
+
+dp.message.middleware(MetricsMiddleware())
+dp.edited_message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
+
 # ================== АВТОПИЛОТ: КОМАНДЫ ==================
 
-@dp.message(F.chat.id.in_(ALLOWED_THREADS.keys()), F.text.regexp(r"^/onAP(\d+)?$"))
-async def handle_autopilot_on(message: Message):
-    if message.message_thread_id != ALLOWED_THREADS.get(message.chat.id):
+@dp.message(shop_chat, F.text.regexp(ONAP_RE).as_("command_match"))
+async def handle_autopilot_on(message: Message, shop: Shop, command_match: re.Match):
+    if message.message_thread_id != shop.thread_id:
         return
 
     if message.from_user.id != UNIQUE_USER_ID:
-        await message.reply("Вам запрещено активировать автопилот!")
+        await reply_to(message, "Вам запрещено активировать автопилот!", priority=PRIORITY_LOW)
         return
 
     chat_id = message.chat.id
     thread_id = message.message_thread_id
 
-    match = re.match(r"^/onAP(\d+)?$", message.text)
-    minutes_str = match.group(1)
+    minutes_str = command_match.group(1)
 
     # если уже был запущен таймер — отменяем его
-    existing = autopilot_state.get(chat_id)
-    if existing and existing.get("task"):
-        existing["task"].cancel()
+    scheduler.cancel(f"autopilot:{chat_id}")
 
     if minutes_str:
         minutes = int(minutes_str)
-        autopilot_state[chat_id] = {"enabled": True, "task": None}
-        task = asyncio.create_task(autopilot_timer(chat_id, thread_id, minutes))
-        autopilot_state[chat_id]["task"] = task
-        await bot.send_message(
+        until = time.time() + minutes * 60
+        autopilot_state[chat_id] = {"enabled": True}
+        schedule_autopilot_off(chat_id, thread_id, until)
+        storage.save_autopilot(chat_id, True, thread_id, until)
+        await send_message(
             chat_id,
             f"Автопилот активен на {minutes} минут и будет отключен автоматически по истечению времени!⌛",
             message_thread_id=thread_id,
+            priority=PRIORITY_LOW,
         )
     else:
-        autopilot_state[chat_id] = {"enabled": True, "task": None}
-        await bot.send_message(
+        autopilot_state[chat_id] = {"enabled": True}
+        storage.save_autopilot(chat_id, True, thread_id, None)
+        await send_message(
             chat_id,
             "Автопилот активирован без ограничений по времени! ✈️",
             message_thread_id=thread_id,
+            priority=PRIORITY_LOW,
         )
 
-@dp.message(F.chat.id.in_(ALLOWED_THREADS.keys()), F.text == "/offAP")
-async def handle_autopilot_off(message: Message):
-    if message.message_thread_id != ALLOWED_THREADS.get(message.chat.id):
+@dp.message(shop_chat, F.text == "/offAP")
+async def handle_autopilot_off(message: Message, shop: Shop):
+    if message.message_thread_id != shop.thread_id:
         return
 
     if message.from_user.id != UNIQUE_USER_ID:
-        await message.reply("Вам запрещено активировать автопилот!")
+        await reply_to(message, "Вам запрещено активировать автопилот!", priority=PRIORITY_LOW)
         return
 
     chat_id = message.chat.id
     thread_id = message.message_thread_id
 
-    state = autopilot_state.get(chat_id)
-    if state and state.get("task"):
-        state["task"].cancel()
-
-    autopilot_state[chat_id] = {"enabled": False, "task": None}
+    scheduler.cancel(f"autopilot:{chat_id}")
+    autopilot_state[chat_id] = {"enabled": False}
+    storage.save_autopilot(chat_id, False, thread_id, None)
 
-    await bot.send_message(
+    await send_message(
         chat_id,
         "Управление переключено в ручной режим! 🫳",
         message_thread_id=thread_id,
+        priority=PRIORITY_LOW,
+    )
+
+# ================== НОЧНАЯ ОЧЕРЕДЬ ==================
+# Ночью заявки не уходят Исполнителю по одной: они копятся в night_orders,
+# адрес проверяется в фоне по NIGHT_AI_CONCURRENCY за раз, а магазин получает
+# «Уже не онлайн» один раз за ночь — с первой заявкой. Во время открытия
+# магазина (night_end) планировщик выпускает очередь: сначала сводка по
+# магазинам (страницами), затем карточки без звука, по очереди через outbox
+# с низким приоритетом — дневные заявки их обгоняют. Правка ночной заявки
+# просто меняет её текст: Исполнитель увидит уже исправленную карточку.
+
+class HeldOrder:
+    __slots__ = (
+        "chat_id", "msg_id", "text", "request_number", "chat_name",
+        "received_at", "verdict", "address_source", "counted",
+    )
+
+    def __init__(self, chat_id: int, msg_id: int, text: str, request_number: str, chat_name: str,
+                 received_at: float | None = None, verdict: dict | None = None, address_source: str | None = None,
+                 counted: bool = False):
+        self.chat_id = chat_id
+        self.msg_id = msg_id
+        self.text = text
+        self.request_number = request_number
+        self.chat_name = chat_name
+        self.received_at = received_at if received_at is not None else time.time()
+        self.verdict = verdict
+        self.address_source = address_source
+        # «неполный адрес» уже учтён в статистике дня получения
+        self.counted = bool(counted)
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HeldOrder":
+        return cls(**{name: data.get(name) for name in cls.__slots__})
+
+def next_opening(shop: Shop) -> float:
+    """Ближайшее время открытия магазина (конец ночи), unix time."""
+    now = datetime.now(TZ)
+    opening = now.replace(hour=shop.night_end.hour, minute=shop.night_end.minute, second=0, microsecond=0)
+    if opening <= now:
+        opening += timedelta(days=1)
+    return opening.timestamp()
+
+class NightQueue:
+    def __init__(self):
+        self._held: dict[tuple[int, int], HeldOrder] = {}
+        self._chats: dict[int, int] = {}
+        self.released = 0
+
+    def hold(self, held: HeldOrder, release_at: float, save: bool = True) -> bool:
+        """Кладёт заявку в очередь. True — первая заявка чата за эту ночь."""
+        first = not self._chats.get(held.chat_id)
+        self._held[(held.chat_id, held.msg_id)] = held
+        self._chats[held.chat_id] = self._chats.get(held.chat_id, 0) + 1
+        if save:
+            storage.save_night_order(held)
+        # выпуск планируется и для не первой заявки: прошлый выпуск мог сорваться
+        self.schedule_release(held.chat_id, release_at)
+        return first
+
+    def schedule_release(self, chat_id: int, release_at: float):
+        if f"night_release:{chat_id}" not in scheduler:
+            scheduler.schedule(f"night_release:{chat_id}", "night_release", {"chat_id": chat_id}, at=release_at)
+
+    def save(self, held: HeldOrder):
+        if (held.chat_id, held.msg_id) in self._held:
+            storage.save_night_order(held)
+
+    def find(self, chat_id: int, msg_id: int) -> HeldOrder | None:
+        return self._held.get((chat_id, msg_id))
+
+    def for_chats(self, chat_ids) -> list[HeldOrder]:
+        chat_ids = set(chat_ids)
+        return sorted((h for h in self._held.values() if h.chat_id in chat_ids), key=lambda h: h.received_at)
+
+    def release(self, held: HeldOrder):
+        if self._held.pop((held.chat_id, held.msg_id), None) is None:
+            return
+        self._chats[held.chat_id] -= 1
+        if not self._chats[held.chat_id]:
+            del self._chats[held.chat_id]
+        storage.delete_night_order(held.chat_id, held.msg_id)
+        self.released += 1
+
+    def load(self) -> int:
+        held_orders = storage.load_night_orders()
+        for held in held_orders:
+            shop = shop_config.get(held.chat_id)
+            # магазин убрали из списка — выпускаем его заявки сразу
+            release_at = next_opening(shop) if shop else time.time()
+            self.hold(held, release_at, save=False)
+        return len(held_orders)
+
+    def stats(self) -> dict:
+        return {"held": len(self._held), "chats": len(self._chats), "released": self.released}
+
+night_queue = NightQueue()
+night_ai_semaphore = asyncio.Semaphore(NIGHT_AI_CONCURRENCY)
+
+async def check_held_order(held: HeldOrder):
+    """Фоновая проверка адреса ночной заявки; правка во время проверки её обнуляет."""
+    async with night_ai_semaphore:
+        text = held.text
+        try:
+            verdict, source = await verify_address(text)
+        except Exception:
+            log.exception("Не удалось проверить адрес ночной заявки %s", held.request_number)
+            return
+    if held.text == text:
+        held.verdict, held.address_source = verdict, source
+        count_held_incomplete(held)
+        night_queue.save(held)
+
+def count_held_incomplete(held: HeldOrder):
+    """«Неполный адрес» ночной заявки учитывается по первой проверке и в день
+    получения: отчёт за этот день к утреннему выпуску уже может быть отправлен."""
+    if held.counted:
+        return
+    held.counted = True
+    if missing_address_fields(held.verdict):
+        daily_stats.count(held.chat_id, "incomplete", at=held.received_at)
+
+async def hold_night_order(message: Message, shop: Shop):
+    if already_handled(message):
+        return
+    held = HeldOrder(
+        chat_id=message.chat.id,
+        msg_id=message.message_id,
+        text=message.text or "",
+        request_number=get_request_number(message),
+        chat_name=shop.name,
     )
+    first = night_queue.hold(held, next_opening(shop))
+    metrics.inc("bot_orders_total", chat=chat_label(message.chat.id), night=True)
+    daily_stats.count(message.chat.id, "received")
+    daily_stats.count(message.chat.id, "night")
+    spawn(check_held_order(held))
+
+    if first:
+        reply_shop(
+            message,
+            f"Уже не онлайн🌃\nНакапливаю заявки — распределим утром.\nГрафик работы: {shop.hours} (без выходных).",
+            priority=PRIORITY_LOW,
+        )
+
+def build_night_digest(held_orders: list[HeldOrder]) -> list[str]:
+    """Сводка ночных заявок по магазинам, разбитая на страницы до NIGHT_DIGEST_PAGE символов."""
+    by_shop: dict[str, list[HeldOrder]] = {}
+    for held in held_orders:
+        by_shop.setdefault(held.chat_name, []).append(held)
+
+    pages: list[list[str]] = [[]]
+    size = 0
+    for chat_name, items in by_shop.items():
+        header = f"<b>{html.escape(chat_name)}</b> — {len(items)}"
+        lines = [("\n" if pages[-1] else "") + header]
+        for held in items:
+            first_line = next((line for line in held.text.splitlines() if line.strip()), "")
+            lines.append(f"• {held.request_number} — {html.escape(first_line[:60])}")
+        for line in lines:
+            # заголовок магазина не остаётся в конце страницы без заявок
+            need = len(line) + 1 + (len(lines[1]) + 1 if line is lines[0] else 0)
+            if pages[-1] and size + need > NIGHT_DIGEST_PAGE:
+                # магазин не влез — продолжаем его список на следующей странице
+                pages.append([] if line is lines[0] else [f"{header} (продолжение)"])
+                line = line.lstrip("\n")
+                size = sum(len(l) + 1 for l in pages[-1])
+            pages[-1].append(line)
+            size += len(line) + 1
+
+    title = f"🌙 Заявки за ночь: {len(held_orders)}"
+    if len(pages) == 1:
+        return [title + "\n\n" + "\n".join(pages[0])]
+    return [f"{title} ({i}/{len(pages)})\n\n" + "\n".join(page) for i, page in enumerate(pages, 1)]
+
+@scheduler.handler("night_release")
+async def release_night_orders(payloads: list[dict]):
+    """Открытие магазинов: сводка, затем карточки ночных заявок по одной."""
+    held_orders = night_queue.for_chats(payload["chat_id"] for payload in payloads)
+    if not held_orders:
+        return
+    try:
+        for page in build_night_digest(held_orders):
+            await send_message(UNIQUE_USER_ID, page, priority=PRIORITY_NORMAL)
+    except Exception:
+        log.exception("Не удалось отправить сводку ночных заявок")
+
+    # одна неудачная карточка не останавливает остальные, а сама
+    # остаётся в очереди и выпускается повторно через NIGHT_RELEASE_RETRY
+    failed = set()
+    for held in held_orders:
+        # заявку могли выпустить раньше (повторный запуск после перезапуска)
+        if not night_queue.find(held.chat_id, held.msg_id):
+            continue
+        try:
+            if held.verdict is None:
+                held.verdict, held.address_source = await verify_address(held.text)
+            count_held_incomplete(held)
+            await send_card(
+                held.chat_id, held.msg_id, held.text, held.chat_name, held.request_number,
+                held.verdict, held.address_source, silent=True, priority=PRIORITY_LOW,
+            )
+        except Exception:
+            log.exception("Не удалось выпустить ночную заявку %s", held.request_number)
+            failed.add(held.chat_id)
+            continue
+        night_queue.release(held)
+    for chat_id in failed:
+        night_queue.schedule_release(chat_id, time.time() + NIGHT_RELEASE_RETRY)
+    metrics.inc("bot_night_releases_total")
 
 # ================== MAIN HANDLER ==================
 
-@dp.message(F.chat.id.in_(ALLOWED_THREADS.keys()))
-async def handle_message(message: Message):
+@dp.message(shop_chat)
+async def handle_message(message: Message, shop: Shop):
     # команды автопилота обрабатываются отдельными хендлерами выше
-    if message.text and re.match(r"^/(onAP|offAP)", message.text):
+    if message.text and AUTOPILOT_COMMAND_RE.match(message.text):
         return
 
-    if message.message_thread_id != ALLOWED_THREADS.get(message.chat.id):
+    if message.message_thread_id != shop.thread_id:
         return
-    if len(message.text or "") < 50:
+    if len(message.text or "") < shop.min_length:
         return
     if message.from_user.id == UNIQUE_USER_ID:
         return
+    if already_handled(message):
+        log.info("Сообщение %s в чате %s уже обработано", message.message_id, message.chat.id)
+        return
 
-    status = validate_contact(message.text or "")
     autopilot = is_autopilot_active(message.chat.id)
-    night = is_night_time() and not autopilot
+    if is_night_time(shop) and not autopilot:
+        await hold_night_order(message, shop)
+        return
 
-    missing_address = []
-    try:
-        addr = check_address_with_ai(message.text or "")
-        missing_address = [k for k, v in addr.items() if v is False and k != "comment"]
-    except Exception:
-        pass
+    # проверка адреса идёт в фоне, пока отвечаем в чат магазина
+    ai_task = asyncio.create_task(verify_address(message.text or ""))
 
-    if night:
-        await message.reply("Уже не онлайн🌃\nНакапливаю заявки — распределим утром.\nГрафик работы: 09:05 - 21:55 (без выходных).")
-    else:
-        if status == "missing":
-            await message.reply(
-                "Номер для связи не обнаружен. "
-                "Доставка возможна без предварительного звонка получателю. "
-                "Риски - на отправителе."
-            )
-        elif status == "invalid":
-            await message.reply (
-                "Заказ не принят в работу. "
-                "Номер телефона получателя в заявке указан некорректно. "
-                "Пожалуйста, укажите номер в формате +375ХХХХХХХХХ или ник Telegram, используя символ @."
-            )
+    status = validate_contact(message.text or "")
+    if status == "missing":
+        reply_shop(
+            message,
+            "Номер для связи не обнаружен. "
+            "Доставка возможна без предварительного звонка получателю. "
+            "Риски - на отправителе.",
+            priority=PRIORITY_LOW,
+        )
+    elif status == "invalid":
+        reply_shop(
+            message,
+            "Заказ не принят в работу. "
+            "Номер телефона получателя в заявке указан некорректно. "
+            "Пожалуйста, укажите номер в формате +375ХХХХХХХХХ или ник Telegram, используя символ @."
+        )
+
+    addr, address_source = await ai_task
+
+    request_number = get_request_number(message)
+    metrics.inc("bot_orders_total", chat=chat_label(message.chat.id), night=False)
+    daily_stats.count(message.chat.id, "received")
+    if missing_address_fields(addr):
+        daily_stats.count(message.chat.id, "incomplete")
+    record = await send_card(
+        message.chat.id, message.message_id, message.text or "", shop.name, request_number,
+        addr, address_source,
+    )
+
+    # автопилот: заказ принимается в работу автоматически, без нажатия кнопки
+    if autopilot:
+        def remember_reply(sent: Message):
+            record.accept_reply_id = sent.message_id
+            orders.save(record)
+
+        reply_shop(message, "Заказ принят в работу.", on_sent=remember_reply)
 
-    request_number = get_request_number()
-    chat_name = CHAT_NAMES.get(message.chat.id, "Чат")
+async def send_card(chat_id: int, msg_id: int, text: str, chat_name: str, request_number: str,
+                    addr: dict, address_source: str, *, silent: bool = False,
+                    priority: int = PRIORITY_HIGH) -> OrderRecord:
+    """Отправляет карточку заявки Исполнителю и заводит запись о заявке."""
+    missing_address = missing_address_fields(addr)
     header = f"{request_number}\n{chat_name}\n\n"
 
     warning = ""
@@ -303,8 +2435,10 @@ async def handle_message(message: Message):
             "НЕПОЛНЫЙ АДРЕС\n"
             f"Отсутствует: {', '.join(missing_address)}\n\n"
         )
+    if address_source == "fallback":
+        warning += AI_FALLBACK_NOTE
 
-    forward_body = header + warning + (message.text or "")
+    forward_body = header + warning + text
 
     if missing_address:
         kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -322,60 +2456,130 @@ async def handle_message(message: Message):
     [InlineKeyboardButton(text="✅ ВЫПОЛНЕН", callback_data="decision:done")]
 ])
 
-    sent = await bot.send_message(
+    # запись о заявке заводится, как только карточка ушла, даже если обработку
+    # апдейта прервала остановка: повтор апдейта увидит заявку и не пришлёт
+    # карточку второй раз. Карточка, не начавшая отправку, при отмене не уходит.
+    created: list[OrderRecord] = []
+
+    def add_record(sent: Message):
+        record = OrderRecord(
+            card_id=sent.message_id,
+            orig_chat_id=chat_id,
+            orig_msg_id=msg_id,
+            original_text=text,
+            request_number=request_number,
+            chat_name=chat_name,
+            address_incomplete=bool(missing_address),
+        )
+        orders.add(record)
+        if SHARDS > 1:
+            storage.index_order(record.card_id, record.orig_chat_id)
+        created.append(record)
+
+    await outbox.submit(
         UNIQUE_USER_ID,
-        forward_body,
-        reply_markup=kb,
-        disable_notification=night,
+        lambda: bot.send_message(
+            UNIQUE_USER_ID, forward_body, reply_markup=kb, disable_notification=silent,
+        ),
+        priority,
+        "sendMessage",
+        on_result=add_record,
     )
-
-    assign_mapping[sent.message_id] = {
-        "orig_chat_id": message.chat.id,
-        "orig_msg_id": message.message_id,
-        "accept_reply_id": None,
-        "address_incomplete": bool(missing_address),
-        "original_text": message.text or "",
-        "edit_notification_id": None,
-        "request_number": request_number,
-        "chat_name": chat_name,
-        "driver_chat_id": None,
-        "driver_msg_id": None,
-        "driver_label": None,
-    }
-
-    # автопилот: заказ принимается в работу автоматически, без нажатия кнопки
-    if autopilot:
-        accept_msg = await bot.send_message(
-            message.chat.id,
-            "Заказ принят в работу.",
-            reply_to_message_id=message.message_id,
-        )
-        assign_mapping[sent.message_id]["accept_reply_id"] = accept_msg.message_id
+    return created[0]
 
 # ================== EDITED MESSAGE HANDLER ==================
+# Магазины часто правят заявку несколько раз подряд. Правки одной заявки
+# копятся EDIT_DEBOUNCE секунд (но не дольше EDIT_DEBOUNCE_MAX с первой),
+# после чего уходит один дифф относительно последнего текста, принятого
+# Исполнителем. Пока правки не приняты, уведомление в чате и карточка
+# правок обновляются на месте, а не отправляются заново.
+
+# card_id -> (задача отложенной обработки, время первой правки в серии)
+pending_edits: dict[int, tuple[asyncio.Task, float]] = {}
 
-@dp.edited_message(F.chat.id.in_(ALLOWED_THREADS.keys()))
+@dp.edited_message(shop_chat)
 async def handle_edited_message(message: Message):
-    info = None
-    admin_msg_id = None
-    for candidate_id, data in assign_mapping.items():
-        if data["orig_msg_id"] == message.message_id and data["orig_chat_id"] == message.chat.id:
-            info = data
-            admin_msg_id = candidate_id
-            break
+    held = night_queue.find(message.chat.id, message.message_id)
+    if held:
+        # ночная заявка ещё не у Исполнителя — просто берём новый текст
+        metrics.inc("bot_edits_total", chat=chat_label(message.chat.id))
+        daily_stats.count(message.chat.id, "edits")
+        held.text = message.text or ""
+        held.verdict = held.address_source = None
+        night_queue.save(held)
+        spawn(check_held_order(held))
+        return
+
+    info = orders.find_by_origin(message.chat.id, message.message_id)
     if not info:
         return
+    metrics.inc("bot_edits_total", chat=chat_label(message.chat.id))
+    daily_stats.count(message.chat.id, "edits")
+
+    now = time.monotonic()
+    first_edit_at = now
+    pending = pending_edits.get(info.card_id)
+    if pending:
+        pending[0].cancel()
+        first_edit_at = pending[1]
+
+    delay = max(0.0, min(EDIT_DEBOUNCE, first_edit_at + EDIT_DEBOUNCE_MAX - now))
+    task = asyncio.create_task(apply_edit_later(info, message, delay))
+    pending_edits[info.card_id] = (task, first_edit_at)
+
+async def apply_edit_later(info: OrderRecord, message: Message, delay: float):
+    try:
+        # при остановке бота накопленная правка применяется сразу
+        await asyncio.wait_for(lifecycle.stopping.wait(), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+    except asyncio.CancelledError:
+        return
+    # дальше правка не отменяется новой — та запланирует свою; применение идёт
+    # фоновой задачей, чтобы остановка дождалась его (см. Lifecycle)
+    pending_edits.pop(info.card_id, None)
+    spawn(run_edit(info, message))
+
+async def run_edit(info: OrderRecord, message: Message):
+    try:
+        await apply_edit(info, message)
+    except Exception:
+        log.exception("Не удалось обработать правку заявки %s", info.request_number)
+
+def touches_address(lines: list[str]) -> bool:
+    return any(
+        pattern.search(line)
+        for line in lines
+        for pattern in (*ADDRESS_PATTERNS.values(), _HOUSE_AFTER_STREET_RE)
+    )
+
+async def apply_edit(info: OrderRecord, message: Message):
+    admin_msg_id = info.card_id
 
-    old_text = info.get("original_text", "")
+    old_text = info.acked_text if info.acked_text is not None else info.original_text
     new_text = message.text or ""
+    if new_text == info.original_text:
+        return
+    info.original_text = new_text
     if old_text == new_text:
+        # серия правок вернула текст к принятому — сообщать нечего
+        orders.save(info)
         return
 
-    old_lines = set(old_text.splitlines())
-    new_lines = set(new_text.splitlines())
-
-    added = "\n".join([line for line in new_lines if line not in old_lines])
-    removed = "\n".join([line for line in old_lines if line not in new_lines])
+    changes = diff_text(old_text, new_text)
+    added = "\n".join(marked for op, _, marked in changes if op == "+")
+    removed = "\n".join(marked for op, _, marked in changes if op == "-")
+
+    # адрес перепроверяется, только если изменились строки с адресом
+    address_warning = ""
+    if touches_address([line for _, line, _ in changes]):
+        addr, address_source = await verify_address(new_text)
+        missing_address = missing_address_fields(addr)
+        info.address_incomplete = bool(missing_address)
+        if missing_address:
+            address_warning = f"НЕПОЛНЫЙ АДРЕС\nОтсутствует: {', '.join(missing_address)}\n\n"
+        if address_source == "fallback":
+            address_warning += AI_FALLBACK_NOTE
 
     # --- Уведомление в чате/теме, откуда пришла заявка ---
     thread_notice = "<b>Обнаружены правки в исходной заявке!</b>\n\n"
@@ -397,128 +2601,563 @@ async def handle_edited_message(message: Message):
         "Дождитесь уведомления о принятии изменений Исполнителем.</i>"
     )
 
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=thread_notice,
-        reply_to_message_id=message.message_id,
-        parse_mode="HTML"
-    )
-
-    # --- Новая карточка заявки для исполнителя (с уникальным id) ---
+    # --- Карточка правок для исполнителя ---
     now_str = datetime.now(TZ).strftime("%d.%m.%Y в %H:%M")
-    thread_id = ALLOWED_THREADS.get(info["orig_chat_id"])
-    link = build_message_link(info["orig_chat_id"], thread_id, info["orig_msg_id"])
+    shop = shop_config.get(info.orig_chat_id)
+    thread_id = shop.thread_id if shop else None
+    link = build_message_link(info.orig_chat_id, thread_id, info.orig_msg_id)
 
-    header = f"{info['request_number']}\n{info['chat_name']}\n\n"
+    header = f"{info.request_number}\n{info.chat_name}\n\n"
     edited_note = f"ОТРЕДАКТИРОВАНО {now_str}\nСсылка на заявку в чате: {link}\n\n"
-    new_card_text = header + edited_note + new_text
+    new_card_text = header + edited_note + address_warning + new_text
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Изменения приняты Исполнителем.", callback_data=f"accept_edit:{admin_msg_id}")]
     ])
 
-    sent_to_user = await bot.send_message(
-        UNIQUE_USER_ID,
-        new_card_text,
-        reply_markup=kb,
-    )
-
-    info["edit_notification_id"] = sent_to_user.message_id
-    info["original_text"] = new_text
+    # пока предыдущие правки не приняты — обновляем уже отправленные сообщения
+    in_place = info.edit_pending
+    if not (in_place and await edit_text(message.chat.id, info.edit_notice_id, thread_notice, parse_mode="HTML")):
+        notice = await reply_to(message, thread_notice, parse_mode="HTML")
+        info.edit_notice_id = notice.message_id
+
+    if not (in_place and await edit_text(
+        UNIQUE_USER_ID, info.edit_notification_id, new_card_text, reply_markup=kb, priority=PRIORITY_HIGH,
+    )):
+        sent_to_user = await send_message(
+            UNIQUE_USER_ID,
+            new_card_text,
+            reply_markup=kb,
+            priority=PRIORITY_HIGH,
+        )
+        info.edit_notification_id = sent_to_user.message_id
+
+    info.edit_pending = True
+    orders.save(info)
+
+# ================== КНОПКИ: ОТВЕТ СРАЗУ, РАБОТА В ФОНЕ ==================
+# На нажатие кнопки бот отвечает сразу (крутилка у исполнителя гаснет),
+# а ответ в чат магазина, правка и удаление карточки идут фоновой задачей.
+# Результат задача дописывает в карточку строкой статуса. Повторные нажатия,
+# пока задача не закончилась (или когда действие уже выполнено), ничего не делают.
+
+CARD_STATUS_SEPARATOR = "\n\n📌 "
+
+# (карточка, вид действия) -> задача, которая его выполняет
+callback_jobs: dict[tuple[int, str], asyncio.Task] = {}
+
+def start_callback_job(key: tuple[int, str], coro) -> bool:
+    """Запускает фоновую задачу кнопки. False — такая задача уже выполняется (повторное нажатие)."""
+    if key in callback_jobs:
+        coro.close()
+        metrics.inc("bot_callback_duplicates_total")
+        return False
+    task = spawn(coro)
+    callback_jobs[key] = task
+    task.add_done_callback(lambda t: callback_jobs.pop(key, None))
+    return True
+
+async def report_on_card(card: Message, status: str):
+    """Дописывает в карточку итог действия, заменяя предыдущий статус; кнопки остаются."""
+    base = (card.html_text or "").split(CARD_STATUS_SEPARATOR)[0]
+    try:
+        await edit_text(
+            card.chat.id,
+            card.message_id,
+            f"{base}{CARD_STATUS_SEPARATOR}{status}",
+            reply_markup=card.reply_markup,
+            priority=PRIORITY_LOW,
+        )
+    except Exception:
+        log.exception("Не удалось обновить карточку %s", card.message_id)
 
 # ================== ACCEPT EDIT CALLBACK ==================
 
 @dp.callback_query(F.data.startswith("accept_edit:"))
 async def accept_edit(callback: CallbackQuery):
     admin_msg_id = int(callback.data.split(":")[1])
-    info = assign_mapping.get(admin_msg_id)
+    info = orders.get(admin_msg_id)
     if not info:
-        await callback.answer("Заявка не найдена", show_alert=True)
+        await answer_callback(callback, "Заявка не найдена", show_alert=True)
         return
 
-    await bot.send_message(
-        chat_id=info["orig_chat_id"],
-        text="Изменения приняты Исполнителем.",
-        reply_to_message_id=info["orig_msg_id"]
-    )
+    if not info.edit_pending and info.acked_text == info.original_text:
+        await answer_callback(callback, "Изменения уже приняты")
+        return
+    if not start_callback_job((admin_msg_id, "accept_edit"), accept_edit_job(info, callback.message)):
+        await answer_callback(callback, "Уже выполняется")
+        return
+    await answer_callback(callback, "изменения приняты")
 
-    await bot.edit_message_reply_markup(
-        chat_id=UNIQUE_USER_ID,
-        message_id=info.get("edit_notification_id"),
-        reply_markup=None
-    )
+async def accept_edit_job(info: OrderRecord, notification: Message):
+    with metrics.timer("bot_callback_job_seconds", kind="accept_edit"):
+        try:
+            await send_message(
+                info.orig_chat_id,
+                "Изменения приняты Исполнителем.",
+                reply_to_message_id=info.orig_msg_id
+            )
+        except Exception:
+            log.exception("Не удалось подтвердить правку заявки %s", info.card_id)
+            await report_on_card(notification, "⚠️ Не удалось сообщить в чат магазина — нажмите ещё раз")
+            return
+
+        info.acked_text = info.original_text
+        info.edit_pending = False
+        orders.save(info)
 
-    await callback.answer("изменения приняты")
+        try:
+            await outbox.submit(UNIQUE_USER_ID, lambda: bot.edit_message_reply_markup(
+                chat_id=UNIQUE_USER_ID,
+                message_id=info.edit_notification_id,
+                reply_markup=None
+            ), PRIORITY_LOW, "editMessageReplyMarkup")
+        except Exception:
+            pass
 
 # ================== ADDRESS DECISION ==================
 
+ADDRESS_ACTIONS = {
+    "fix": (
+        "Пожалуйста, дополните адрес:\n"
+        "улица, дом, подъезд, этаж, квартира",
+        "Ожидаю уточнение",
+    ),
+    "skip": (
+        "Заявка передана без уточнения адреса.\n"
+        "Уточнение — платная опция для водителя.",
+        "Передано без уточнений",
+    ),
+}
+
 @dp.callback_query(F.data.startswith("address:"))
 async def handle_address(callback: CallbackQuery):
     action = callback.data.split(":")[1]
+    if action not in ADDRESS_ACTIONS:
+        return
 
-    if action == "fix":
-        await callback.message.reply(
-            "Пожалуйста, дополните адрес:\n"
-            "улица, дом, подъезд, этаж, квартира"
-        )
-        await callback.answer("Ожидаю уточнение")
+    text, answer = ADDRESS_ACTIONS[action]
+    if not start_callback_job((callback.message.message_id, "address"), address_job(callback.message, text)):
+        await answer_callback(callback, "Уже выполняется")
+        return
+    await answer_callback(callback, answer)
 
-    elif action == "skip":
-        await callback.message.reply(
-            "Заявка передана без уточнения адреса.\n"
-            "Уточнение — платная опция для водителя."
-        )
-        await callback.answer("Передано без уточнений")
+async def address_job(card: Message, text: str):
+    with metrics.timer("bot_callback_job_seconds", kind="address"):
+        try:
+            await reply_to(card, text)
+        except Exception:
+            log.exception("Не удалось ответить на выбор по адресу")
+            await report_on_card(card, "⚠️ Не удалось отправить ответ — нажмите ещё раз")
 
 # ================== DECISIONS ==================
 
+DECISION_REPLIES = {
+    "accept": "Заказ принят в работу.",
+    "reject": "Заказ не принят в работу. Доставка невозможна в пределах предложенного интервала.",
+    "rework": (
+        "Заказ принят в работу с ограничениями: требуется доработка исходной заявки.\n\n"
+        "🏠 Для жилых помещений указываются: адрес, подъезд, этаж, номер квартиры, комментарий (при необходимости).\n\n"
+        "🏢 Для коммерческих помещений указываются: адрес, номер офиса/блока/секции, ориентиры входа, режим доступа и иные сведения, необходимые для осуществления доставки.\n\n"
+        "Пожалуйста, уточните недостающие данные и откорректируйте исходную заявку до передачи товара Исполнителю. "
+        "После передачи товара, уточнение производится силами Исполнителя платно, согласно принятым тарифам."
+    ),
+}
+
+# статус заявки -> строка в карточке
+DECISION_STATUSES = {
+    "accepted": "✅ Принят, магазин уведомлён",
+    "rejected": "⛔️ Отклонён, магазин уведомлён",
+    "rework": "🛠 Запрошена доработка, магазин уведомлён",
+}
+
+DECISION_ANSWERS = {
+    "accept": "Готово",
+    "reject": "Готово",
+    "rework": "Запрос доработки отправлен",
+    "done": "Карточка удалена",
+}
+
 @dp.callback_query(F.data.startswith("decision:"))
 async def handle_decision(callback: CallbackQuery):
     admin_msg_id = callback.message.message_id
-    info = assign_mapping.get(admin_msg_id)
+    info = orders.get(admin_msg_id)
     if not info:
-        await callback.answer("Заявка не найдена", show_alert=True)
+        await answer_callback(callback, "Заявка не найдена", show_alert=True)
         return
 
     action = callback.data.split(":")[1]
-    orig_chat_id = info["orig_chat_id"]
-    orig_msg_id = info["orig_msg_id"]
-
-    if action == "accept":
-        sent = await bot.send_message(
-            orig_chat_id,
-            "Заказ принят в работу.",
-            reply_to_message_id=orig_msg_id
-        )
-        info["accept_reply_id"] = sent.message_id
+    status = {"accept": "accepted", "reject": "rejected", "rework": "rework"}.get(action)
+    if status and info.status == status:
+        metrics.inc("bot_callback_duplicates_total")
+        await answer_callback(callback, "Уже сделано")
+        return
+
+    # одно решение по карточке за раз: повторные и встречные нажатия ждут окончания
+    if not start_callback_job((admin_msg_id, "decision"), decision_job(info, action, status, callback.message)):
+        await answer_callback(callback, "Уже выполняется")
+        return
+    metrics.inc("bot_decisions_total", action=action)
+    await answer_callback(callback, DECISION_ANSWERS.get(action, "Готово"))
+
+async def decision_job(info: OrderRecord, action: str, status: str | None, card: Message):
+    with metrics.timer("bot_callback_job_seconds", kind="decision"):
+        if status is None:
+            try:
+                await outbox.submit(UNIQUE_USER_ID, lambda: bot.delete_message(UNIQUE_USER_ID, info.card_id), PRIORITY_HIGH, "deleteMessage")
+            except Exception:
+                log.exception("Не удалось удалить карточку %s", info.card_id)
+                await report_on_card(card, "⚠️ Не удалось удалить карточку — нажмите ещё раз")
+                return
+            storage.set_history_status(info.card_id, "done")
+            orders.remove(info.card_id)
+            return
+
+        try:
+            sent = await send_message(
+                info.orig_chat_id,
+                DECISION_REPLIES[action],
+                reply_to_message_id=info.orig_msg_id
+            )
+        except Exception:
+            log.exception("Не удалось отправить решение по заявке %s", info.card_id)
+            await report_on_card(card, "⚠️ Магазин не уведомлён — нажмите ещё раз")
+            return
+
+        if action == "accept":
+            info.accept_reply_id = sent.message_id
+        # время до решения считается по первому решению, смена решения его не меняет
+        if info.status == "new":
+            daily_stats.observe_decision(info.orig_chat_id, time.time() - info.created_at)
+        daily_stats.count(info.orig_chat_id, status)
+        orders.set_status(info, status)
+        await report_on_card(card, DECISION_STATUSES[status])
+
+# ================== СТАТИСТИКА ==================
+
+def format_seconds(value: float | None) -> str:
+    if value is None:
+        return "—"
+    if value == float("inf"):
+        return f"более {LATENCY_BUCKETS[-1]} с"
+    return f"{value * 1000:.0f} мс" if value < 1 else f"{value:.1f} с"
+
+@dp.message(F.chat.type == "private", F.from_user.id == UNIQUE_USER_ID, Command("stats"))
+async def handle_stats(message: Message):
+    uptime = int(time.time() - metrics.started_at)
+    queue = outbox.stats()
+    cache = address_cache.stats()
+    store = orders.stats()
+
+    lines = [
+        "📊 Статистика",
+        f"Аптайм: {uptime // 3600} ч {uptime % 3600 // 60} мин",
+        "",
+        f"Заявок: {metrics.total('bot_orders_total'):.0f} "
+        f"(ночью {metrics.total('bot_orders_total', night=True):.0f}), "
+        f"правок: {metrics.total('bot_edits_total'):.0f}, "
+        f"отклонено: {metrics.total('bot_decisions_total', action='reject'):.0f}",
+        f"Проверка адреса: правилами {metrics.total('bot_address_checks_total', source='rules'):.0f}, "
+        f"ИИ {metrics.total('bot_address_checks_total', source='ai'):.0f}, "
+        f"ошибок ИИ {metrics.total('bot_ai_failures_total'):.0f}",
+        f"Предохранитель ИИ: {ai_breaker.state}",
+        f"Кэш ИИ: {cache['hits']} попаданий, {cache['misses']} промахов, {cache['coalesced']} склеено",
+        "",
+        f"Хендлеры p50/p95: {format_seconds(metrics.quantile('bot_handler_seconds', 0.5))} / "
+        f"{format_seconds(metrics.quantile('bot_handler_seconds', 0.95))}",
+        f"ИИ p95: {format_seconds(metrics.quantile('bot_ai_check_seconds', 0.95))}",
+        f"Telegram p95: {format_seconds(metrics.quantile('bot_telegram_call_seconds', 0.95))}",
+        f"Очередь исходящих: {queue['depth']}, ожидание ср./макс: "
+        f"{format_seconds(queue['wait_avg'])} / {format_seconds(queue['wait_max'])}",
+        f"Задержка event loop p95: {format_seconds(metrics.quantile('bot_event_loop_lag_seconds', 0.95))}",
+        f"Заявок в памяти: {store['orders']} (~{store['memory_bytes'] // 1024} КБ)",
+        f"В ночной очереди: {night_queue.stats()['held']}",
+    ]
+    await reply_to(message, "\n".join(lines), priority=PRIORITY_HIGH)
+
+@dp.message(F.chat.type == "private", F.from_user.id == UNIQUE_USER_ID, Command("reload"))
+async def handle_reload(message: Message):
+    result = shop_config.reload(force=True) or f"Файл {shop_config.path} не найден, используется встроенный список."
+    await reply_to(message, html.escape(result), priority=PRIORITY_HIGH)
+
+# ================== СТАТИСТИКА ПО МАГАЗИНАМ ==================
+# Счётчики за день по каждому магазину обновляются в момент события
+# (заявка, решение, правка) и пишутся в shop_stats отложенной записью —
+# отчёт читает готовые числа за день, без обхода заявок. Время до решения
+# копится в QuantileSketch: логарифмические корзины дают квантили с
+# относительной погрешностью ~2% при паре сотен корзин на магазин в день.
+
+STAT_NAMES = {
+    "received": "получено",
+    "night": "ночью",
+    "accepted": "принято",
+    "rejected": "отклонено",
+    "rework": "доработка",
+    "incomplete": "неполный адрес",
+    "edits": "правок",
+}
+
+class QuantileSketch:
+    def __init__(self, accuracy: float = 0.02, buckets: dict[int, int] | None = None, count: int = 0):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.buckets = buckets or {}
+        self.count = count
+
+    def add(self, value: float):
+        index = math.ceil(math.log(max(value, 0.001), self.gamma))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q * self.count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # середина корзины (gamma^(i-1), gamma^i]
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return None
+
+    def to_dict(self) -> dict:
+        return {"accuracy": self.accuracy, "buckets": self.buckets, "count": self.count}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "QuantileSketch":
+        buckets = {int(index): count for index, count in data["buckets"].items()}
+        return cls(data["accuracy"], buckets, data["count"])
+
+def stats_date(ts: float | None = None) -> str:
+    return datetime.fromtimestamp(ts if ts is not None else time.time(), TZ).strftime("%Y-%m-%d")
+
+class DailyStats:
+    def __init__(self):
+        self.date: str | None = None
+        # chat_id -> {счётчик: значение} и chat_id -> время до решения за self.date
+        self._counters: dict[int, dict[str, int]] = {}
+        self._decisions: dict[int, QuantileSketch] = {}
+
+    def _roll(self) -> str:
+        date = stats_date()
+        if date != self.date:
+            self.date = date
+            self._counters.clear()
+            self._decisions.clear()
+        return date
+
+    def count(self, chat_id: int, name: str, at: float | None = None):
+        """Событие в день at (по умолчанию — сейчас)."""
+        today = self._roll()
+        date = stats_date(at) if at is not None else today
+        if date == today:
+            counters = self._counters.setdefault(chat_id, {})
+            value = counters[name] = counters.get(name, 0) + 1
+        else:
+            # событие прошлого дня, например ночная заявка, проверенная после полуночи
+            value = storage.load_stat(date, chat_id, name, 0) + 1
+        storage.save_stat(date, chat_id, name, value)
+
+    def observe_decision(self, chat_id: int, seconds: float):
+        date = self._roll()
+        sketch = self._decisions.setdefault(chat_id, QuantileSketch())
+        sketch.add(seconds)
+        storage.save_stat(date, chat_id, "decision_seconds", sketch.to_dict())
+
+    def load(self):
+        """Поднимает сегодняшние счётчики своих чатов, чтобы продолжить их после перезапуска."""
+        date = self._roll()
+        for chat_id, values in storage.load_stats(date).items():
+            if not is_own_chat(chat_id):
+                continue
+            sketch = values.pop("decision_seconds", None)
+            self._counters[chat_id] = values
+            if sketch:
+                self._decisions[chat_id] = QuantileSketch.from_dict(sketch)
+
+daily_stats = DailyStats()
+
+def build_daily_report(date: str) -> str:
+    # сегодняшние числа других шардов ещё могут лежать в их очереди записи — отстают не больше DB_FLUSH_INTERVAL
+    storage.flush()
+    stats = storage.load_stats(date)
+    title = f"📊 Отчёт за {datetime.strptime(date, '%Y-%m-%d'):%d.%m.%Y}"
+    if not stats:
+        return f"{title}\n\nЗаявок не было."
+
+    totals: dict[str, int] = {}
+    total_sketch = QuantileSketch()
+    blocks = []
+    for chat_id, values in sorted(stats.items(), key=lambda item: -item[1].get("received", 0)):
+        shop = shop_config.get(chat_id)
+        name = shop.name if shop else str(chat_id)
+        parts = []
+        for key, label in STAT_NAMES.items():
+            value = values.get(key, 0)
+            totals[key] = totals.get(key, 0) + value
+            if value:
+                parts.append(f"{label} {value}")
+        line = f"<b>{html.escape(name)}</b>\n" + (", ".join(parts) or "без событий")
+        if values.get("decision_seconds"):
+            sketch = QuantileSketch.from_dict(values["decision_seconds"])
+            for index, count in sketch.buckets.items():
+                total_sketch.buckets[index] = total_sketch.buckets.get(index, 0) + count
+            total_sketch.count += sketch.count
+            line += (
+                f"\nрешение p50/p90: {format_seconds(sketch.quantile(0.5))} / "
+                f"{format_seconds(sketch.quantile(0.9))}"
+            )
+        blocks.append(line)
 
-    elif action == "reject":
-        await bot.send_message(
-            orig_chat_id,
-            "Заказ не принят в работу. Доставка невозможна в пределах предложенного интервала.",
-            reply_to_message_id=orig_msg_id
+    summary = ", ".join(f"{label} {totals[key]}" for key, label in STAT_NAMES.items() if totals.get(key))
+    if total_sketch.count:
+        summary += (
+            f"\nрешение p50/p90: {format_seconds(total_sketch.quantile(0.5))} / "
+            f"{format_seconds(total_sketch.quantile(0.9))}"
         )
+    return f"{title}\n\nВсего: {summary}\n\n" + "\n\n".join(blocks)
+
+def parse_report_date(arg: str | None) -> str | None:
+    now = datetime.now(TZ)
+    if not arg:
+        return now.strftime("%Y-%m-%d")
+    if arg.lower() == "вчера":
+        return (now - timedelta(days=1)).strftime("%Y-%m-%d")
+    match = _DATE_QUERY_RE.match(arg)
+    if not match:
+        return None
+    day, month, year = match.groups()
+    try:
+        return datetime(int(year or now.year), int(month), int(day)).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+@dp.message(F.chat.type == "private", F.from_user.id == UNIQUE_USER_ID, Command("report"))
+async def handle_report(message: Message, command: CommandObject):
+    date = parse_report_date((command.args or "").strip())
+    if date is None:
+        await reply_to(message, "Формат: /report, /report вчера или /report 17.10", priority=PRIORITY_HIGH)
+        return
+    await reply_to(message, build_daily_report(date), priority=PRIORITY_HIGH)
+
+def schedule_daily_report():
+    """Ставит сводку за прошедший день на ближайшее DAILY_REPORT_TIME (только один процесс)."""
+    if not DAILY_REPORT_TIME or SHARD_INDEX not in (None, 0) or "daily_report" in scheduler:
+        return
+    at = dtime.fromisoformat(DAILY_REPORT_TIME)
+    now = datetime.now(TZ)
+    due = now.replace(hour=at.hour, minute=at.minute, second=0, microsecond=0)
+    if due <= now:
+        due += timedelta(days=1)
+    date = (due - timedelta(days=1)).strftime("%Y-%m-%d")
+    scheduler.schedule("daily_report", "daily_report", {"date": date}, at=due.timestamp())
+
+@scheduler.handler("daily_report")
+async def send_daily_report(payloads: list[dict]):
+    try:
+        for payload in payloads:
+            await send_message(UNIQUE_USER_ID, build_daily_report(payload["date"]), priority=PRIORITY_LOW)
+    finally:
+        schedule_daily_report()
+
+# ================== ПОИСК ЗАЯВОК ==================
+# /find ищет по всей истории заявок (order_history) через инвертированный
+# индекс order_terms: термы tel:, user:, st:, shop:, date: пишутся вместе с
+# заявкой при каждом её сохранении (новая заявка, правка, решение), поэтому
+# индекс всегда актуален. Каждое слово запроса — префикс терма, слова
+# объединяются через И: «/find +37529 тимир» — номер с 37529 на улице Тимир….
+
+FIND_LIMIT = 10
+
+_STREET_NAME_RE = re.compile(rf"(?i:(?<![а-яё])(?:{_STREET_TYPES})\.?\s+)([А-ЯЁа-яё][а-яё\-]{{2,}})")
+_WORD_RE = re.compile(r"[a-zа-яё0-9]{3,}")
+_DATE_QUERY_RE = re.compile(r"^(\d{1,2})\.(\d{1,2})(?:\.(\d{4}))?$")
+
+HISTORY_STATUSES = {
+    "new": "ожидает решения",
+    "accepted": "принят",
+    "rejected": "отклонён",
+    "rework": "доработка",
+    "done": "выполнен",
+}
 
-    elif action == "rework":
-        await bot.send_message(
-            orig_chat_id,
-            "Заказ принят в работу с ограничениями: требуется доработка исходной заявки.\n\n"
-            "🏠 Для жилых помещений указываются: адрес, подъезд, этаж, номер квартиры, комментарий (при необходимости).\n\n"
-            "🏢 Для коммерческих помещений указываются: адрес, номер офиса/блока/секции, ориентиры входа, режим доступа и иные сведения, необходимые для осуществления доставки.\n\n"
-            "Пожалуйста, уточните недостающие данные и откорректируйте исходную заявку до передачи товара Исполнителю. "
-            "После передачи товара, уточнение производится силами Исполнителя платно, согласно принятым тарифам.",
-            reply_to_message_id=orig_msg_id
+def normalize_term(word: str) -> str:
+    return word.lower().replace("ё", "е")
+
+def order_terms(record: OrderRecord) -> set[str]:
+    text = record.original_text or ""
+    terms = {f"tel:{phone}" for phone in extract_phones(text)}
+    terms |= {f"user:{name.lower()}" for name in USERNAME_RE.findall(text)}
+    terms |= {f"st:{normalize_term(name)}" for name in _STREET_NAME_RE.findall(text)}
+    # «Тимирязева, 67» без «ул.»: название — первое слово после типа улицы, если он есть
+    for match in _HOUSE_AFTER_STREET_RE.finditer(text):
+        name = match.group(0)[match.end(1) - match.start():] if match.group(1) else match.group(0)
+        words = _WORD_RE.findall(normalize_term(name))
+        if words:
+            terms.add(f"st:{words[0]}")
+    terms |= {f"shop:{word}" for word in _WORD_RE.findall(normalize_term(record.chat_name or ""))}
+    terms.add("date:" + datetime.fromtimestamp(record.created_at, TZ).strftime("%Y-%m-%d"))
+    return terms
+
+def parse_find_query(query: str) -> list[list[str]]:
+    """Слова запроса -> группы префиксов термов (внутри группы — ИЛИ)."""
+    groups = []
+    for word in query.split():
+        digits = NON_DIGIT_RE.sub("", word)
+        date = _DATE_QUERY_RE.match(word)
+        if word.startswith("@"):
+            groups.append([f"user:{word[1:].lower()}"])
+        elif date:
+            day, month, year = date.groups()
+            year = year or datetime.now(TZ).strftime("%Y")
+            groups.append([f"date:{year}-{int(month):02d}-{int(day):02d}"])
+        elif len(digits) >= 5 and len(digits) >= len(word) - 4:
+            # +37529…, 8029…, 29…: приводим к 375…; короче кода страны — ищем как есть
+            if digits.startswith("80"):
+                digits = "375" + digits[2:]
+            elif not digits.startswith("375") and len(digits) <= 9:
+                digits = "375" + digits
+            groups.append([f"tel:{digits}"])
+        else:
+            term = normalize_term(word)
+            groups.append([f"st:{term}", f"shop:{term}"])
+    return groups
+
+def format_history_row(row: tuple) -> str:
+    card_id, chat_id, msg_id, request_number, chat_name, status, created_at, text = row
+    shop = shop_config.get(chat_id)
+    link = build_message_link(chat_id, shop.thread_id if shop else None, msg_id)
+    first_line = next((line for line in text.splitlines() if line.strip()), "")
+    created = datetime.fromtimestamp(created_at, TZ).strftime("%d.%m.%Y %H:%M")
+    return (
+        f"<b>{html.escape(request_number or '—')}</b> · {html.escape(chat_name or '')}\n"
+        f"{HISTORY_STATUSES.get(status, status)} · {created}\n"
+        f"{html.escape(first_line[:80])}\n"
+        f"{link}"
+    )
+
+@dp.message(F.chat.type == "private", F.from_user.id == UNIQUE_USER_ID, Command("find"))
+async def handle_find(message: Message, command: CommandObject):
+    groups = parse_find_query(command.args or "")
+    if not groups:
+        await reply_to(
+            message,
+            "Поиск по заявкам: /find +37529… | @ник | улица | магазин | 17.10 — слова можно сочетать.",
+            priority=PRIORITY_HIGH,
         )
-        await callback.answer("Запрос доработки отправлен")
         return
 
-    else:
-        await bot.delete_message(UNIQUE_USER_ID, admin_msg_id)
-        assign_mapping.pop(admin_msg_id, None)
-        await callback.answer("Карточка удалена")
+    with metrics.timer("bot_find_seconds"):
+        rows = storage.search_history(groups, FIND_LIMIT + 1)
+    if not rows:
+        await reply_to(message, "Ничего не найдено.", priority=PRIORITY_HIGH)
         return
 
-    await callback.answer("Готово")
+    lines = [format_history_row(row) for row in rows[:FIND_LIMIT]]
+    if len(rows) > FIND_LIMIT:
+        lines.append(f"Показаны последние {FIND_LIMIT}, уточните запрос.")
+    await reply_to(message, "\n\n".join(lines), priority=PRIORITY_HIGH, disable_web_page_preview=True)
 
 # ================== НАЗНАЧЕНИЕ ИСПОЛНИТЕЛЯ ==================
 # ВНИМАНИЕ: пересылка карточки заказа водителю в личные сообщения отключена.
@@ -526,36 +3165,696 @@ async def handle_decision(callback: CallbackQuery):
 
 @dp.message(F.from_user.id == UNIQUE_USER_ID, F.reply_to_message)
 async def handle_admin_assign_reply(message: Message):
-    reply_to = message.reply_to_message
-    info = assign_mapping.get(reply_to.message_id)
+    replied = message.reply_to_message
+    info = orders.get(replied.message_id)
     if not info:
         return
 
     target = (message.text or "").strip()
     if not target.startswith("@"):
-        await message.reply("Укажи ник в формате @username")
+        await reply_to(message, "Укажи ник в формате @username", priority=PRIORITY_LOW)
         return
 
-    await bot.send_message(
-        info["orig_chat_id"],
+    await send_message(
+        info.orig_chat_id,
         f"Доставка для {target}",
-        reply_to_message_id=info["orig_msg_id"]
+        reply_to_message_id=info.orig_msg_id
     )
 
-    confirm = await message.reply("Готово — уведомил чат.")
-    asyncio.create_task(delete_messages_later(
+    confirm = await reply_to(message, "Готово — уведомил чат.", priority=PRIORITY_LOW)
+    delete_messages_later(
         UNIQUE_USER_ID,
         [message.message_id, confirm.message_id],
         delay=300
-    ))
+    )
+
+# ================== ВХОДЯЩИЕ: WEBHOOK, POLLING И ЖУРНАЛ ==================
+# Апдейт сначала дописывается в журнал на диске — только после этого Telegram
+# получает 200 (webhook) или сдвигается offset (polling), — а обработкой
+# занимаются воркеры. Обработанные update_id
+# пишутся в отдельный файл; при старте необработанные апдейты проигрываются
+# заново, а повторная доставка того же update_id игнорируется — без двойных
+# карточек и лишних номеров заявок.
+
+INBOX_COMPACT_EVERY = 1000
+INBOX_DEDUP_WINDOW = 10000
+
+class Inbox:
+    def __init__(self, path: str):
+        self.path = path
+        self.done_path = path + ".done"
+        self._queue: asyncio.Queue[dict] = asyncio.Queue()
+        # недавние update_id — для отбрасывания повторов
+        self._seen: set[int] = set()
+        self._seen_order: deque[int] = deque()
+        self._pending = 0
+        self._written = 0
+        self._log = None
+        self._done_log = None
+
+    def open(self) -> int:
+        """Открывает журнал и ставит в очередь необработанные апдейты. Возвращает их число."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        done: set[int] = set()
+        if os.path.exists(self.done_path):
+            with open(self.done_path, encoding="utf-8") as f:
+                done = {int(line) for line in f if line.strip()}
+
+        unfinished = []
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        update = json.loads(line)
+                    except ValueError:
+                        continue  # недописанная строка при аварийной остановке
+                    if update["update_id"] not in done:
+                        unfinished.append(update)
+
+        # журнал переписывается только необработанными апдейтами; недавние
+        # обработанные update_id сохраняются, чтобы отсеивать повторы и после рестарта
+        recent_done = sorted(done)[-INBOX_DEDUP_WINDOW:]
+        self._rewrite(unfinished, recent_done)
+        for update_id in recent_done:
+            self._remember(update_id)
+        for update in unfinished:
+            self._remember(update["update_id"])
+            self._enqueue(update)
+        return len(unfinished)
+
+    def _rewrite(self, updates: list[dict], done_ids: list[int]):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for update in updates:
+                f.write(json.dumps(update, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        self._log = open(self.path, "a", encoding="utf-8")
+        self._done_log = open(self.done_path, "w", encoding="utf-8")
+        self._done_log.writelines(f"{update_id}\n" for update_id in done_ids)
+        self._done_log.flush()
+        self._written = len(updates)
+
+    def _remember(self, update_id: int):
+        self._seen.add(update_id)
+        self._seen_order.append(update_id)
+        if len(self._seen_order) > INBOX_DEDUP_WINDOW:
+            self._seen.discard(self._seen_order.popleft())
+
+    def _enqueue(self, update: dict):
+        self._pending += 1
+        self._queue.put_nowait(update)
+
+    def append(self, update: dict) -> bool:
+        """Сохраняет апдейт и ставит в очередь. False — такой update_id уже был."""
+        update_id = update["update_id"]
+        if update_id in self._seen:
+            return False
+        self._log.write(json.dumps(update, ensure_ascii=False) + "\n")
+        self._log.flush()
+        self._written += 1
+        self._remember(update_id)
+        self._enqueue(update)
+        return True
+
+    def checkpoint(self, update: dict) -> bool:
+        """Дописывает в журнал апдейт, поданный в диспетчер мимо него, чтобы проиграть его
+        при следующем старте. False — апдейт уже в журнале."""
+        update_id = update["update_id"]
+        if update_id in self._seen:
+            return False
+        self._log.write(json.dumps(update, ensure_ascii=False) + "\n")
+        self._log.flush()
+        self._written += 1
+        self._remember(update_id)
+        return True
+
+    def mark_done(self, update_id: int):
+        self._done_log.write(f"{update_id}\n")
+        self._done_log.flush()
+        self._pending -= 1
+        if not self._pending and self._written >= INBOX_COMPACT_EVERY:
+            self._log.close()
+            self._done_log.close()
+            self._rewrite([], list(self._seen_order))
+
+    async def worker(self, bot: Bot, dispatcher: Dispatcher):
+        while True:
+            update = await self._queue.get()
+            try:
+                await dispatcher.feed_raw_update(bot, update)
+            except asyncio.CancelledError:
+                # остановка посреди обработки: апдейт останется в журнале и будет проигран снова
+                raise
+            except Exception:
+                log.exception("Ошибка обработки апдейта %s", update.get("update_id"))
+            self.mark_done(update["update_id"])
+            self._queue.task_done()
+
+    def start(self, bot: Bot, dispatcher: Dispatcher, workers: int) -> list[asyncio.Task]:
+        return [asyncio.create_task(self.worker(bot, dispatcher)) for _ in range(workers)]
+
+    def stats(self) -> dict:
+        return {"pending": self._pending, "queued": self._queue.qsize()}
+
+inbox = Inbox(os.path.join(DATA_DIR, f"inbox{SHARD_SUFFIX}.jsonl"))
+
+async def handle_webhook(request: web.Request) -> web.Response:
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    try:
+        update = await request.json()
+        update["update_id"]
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+    inbox.append(update)
+    return web.Response()
+
+async def run_webhook(handler=handle_webhook):
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handler)
+    if METRICS_PORT == WEBHOOK_PORT:
+        app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        drop_pending_updates=False,
+    )
+    log.info("Webhook слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await lifecycle.stopping.wait()
+    finally:
+        await runner.cleanup()
+
+# пауза после ошибки getUpdates растёт от 1 до POLL_BACKOFF_MAX секунд
+POLL_BACKOFF_MAX = 30
+
+async def poll_updates(accept):
+    """Long polling: пачка апдейтов передаётся в accept, и только после этого
+    сдвигается offset — апдейт, не сохранённый до остановки, Telegram пришлёт снова.
+    Ошибки не останавливают опрос: например, TelegramConflictError, пока при
+    передеплое ещё жив старый процесс, или сбой accept — пачка придёт повторно."""
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    webhook_deleted = False
+    backoff = 1
+    while True:
+        try:
+            if not webhook_deleted:
+                await bot.delete_webhook(drop_pending_updates=False)
+                webhook_deleted = True
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            if updates:
+                await accept([update.model_dump(mode="json", by_alias=True, exclude_none=True) for update in updates])
+                offset = updates[-1].update_id + 1
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+            continue
+        except (TelegramNetworkError, TelegramServerError, TelegramConflictError) as e:
+            log.warning("getUpdates: %s, повтор через %s с", e, backoff)
+        except Exception:
+            log.exception("Ошибка long polling, повтор через %s с", backoff)
+        else:
+            backoff = 1
+            continue
+        metrics.inc("bot_polling_errors_total")
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, POLL_BACKOFF_MAX)
+
+async def poll_to_inbox(updates: list[dict]):
+    # как и в webhook: сначала журнал, затем воркеры; повторы update_id отбрасываются
+    for update in updates:
+        inbox.append(update)
+
+# ================== ШАРДЫ: НЕСКОЛЬКО ПРОЦЕССОВ ==================
+# При SHARDS > 1 главный процесс сам апдейты не обрабатывает: он получает их
+# (polling или webhook) и пачками пересылает шардам — процессам с тем же
+# main.py и SHARD_INDEX, которые слушают 127.0.0.1:SHARD_BASE_PORT+номер.
+# Чат всегда попадает в один шард (chat_id % SHARDS), порядок апдейтов
+# внутри шарда сохраняется. Нажатия кнопок и ответы Исполнителя на карточку
+# идут шарду, которому принадлежит заявка (таблица order_index). Общее
+# состояние — номера заявок, известные пользователи, сами заявки — в одной
+# базе SQLite (WAL), в которую пишут все шарды. Апдейт считается принятым,
+# когда шард записал его в свой журнал: только тогда главный процесс отвечает
+# Telegram (webhook) или сдвигает offset (polling).
+
+SHARD_BATCH_MAX = 100
+
+class ShardRouter:
+    def __init__(self, shards: int, base_port: int, token: str):
+        self.shards = shards
+        self.base_port = base_port
+        self.token = token
+        self._queues: list[asyncio.Queue[tuple[dict, asyncio.Future]]] = [asyncio.Queue() for _ in range(shards)]
+        self._session: ClientSession | None = None
+        # апдейты, взятые из очередей и ещё не подтверждённые шардом
+        self._sending = 0
+
+    def shard_for_card(self, card_id: int | None) -> int:
+        chat_id = storage.order_chat(card_id) if card_id else None
+        return shard_of(chat_id) if chat_id is not None else 0
+
+    def shard_for_update(self, update: dict) -> int:
+        for kind in ("message", "edited_message"):
+            message = update.get(kind)
+            if not message:
+                continue
+            if message["chat"]["id"] == UNIQUE_USER_ID:
+                # личка Исполнителя: ответ на карточку — шарду заявки, команды — шарду 0
+                reply = message.get("reply_to_message")
+                return self.shard_for_card(reply["message_id"]) if reply else 0
+            return shard_of(message["chat"]["id"])
+
+        callback = update.get("callback_query")
+        if callback:
+            data = callback.get("data") or ""
+            if data.startswith("accept_edit:"):
+                return self.shard_for_card(int(data.split(":")[1]))
+            return self.shard_for_card((callback.get("message") or {}).get("message_id"))
+        return 0
+
+    def route(self, update: dict) -> asyncio.Future:
+        """Ставит апдейт в очередь его шарда; future завершается, когда шард его сохранил."""
+        future = asyncio.get_running_loop().create_future()
+        shard = self.shard_for_update(update)
+        self._queues[shard].put_nowait((update, future))
+        return future
+
+    async def forward(self, shard: int):
+        url = f"http://127.0.0.1:{self.base_port + shard}/updates"
+        queue = self._queues[shard]
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < SHARD_BATCH_MAX and not queue.empty():
+                batch.append(queue.get_nowait())
+            payload = [update for update, _ in batch]
+            self._sending += len(batch)
+            try:
+                # шард мог ещё не подняться или перезапускаться — повторяем до успеха
+                delay = 0.1
+                while True:
+                    try:
+                        with metrics.timer("bot_shard_forward_seconds", shard=str(shard)):
+                            async with self._session.post(url, json=payload, headers={"X-Shard-Token": self.token}) as resp:
+                                resp.raise_for_status()
+                        break
+                    except (ClientError, OSError):
+                        await asyncio.sleep(delay)
+                        delay = min(delay * 2, 5.0)
+            finally:
+                self._sending -= len(batch)
+            metrics.inc("bot_shard_updates_total", shard=str(shard))
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    async def supervise(self, shard: int):
+        """Запускает процесс шарда и перезапускает его, если он завершился."""
+        env = {**os.environ, "SHARD_INDEX": str(shard), "SHARD_TOKEN": self.token}
+        env.pop("WEBHOOK_URL", None)
+        while True:
+            process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            try:
+                code = await process.wait()
+            except asyncio.CancelledError:
+                process.terminate()
+                await process.wait()
+                raise
+            if lifecycle.stopping.is_set():
+                return
+            log.warning("Шард %d завершился с кодом %s, перезапуск", shard, code)
+            metrics.inc("bot_shard_restarts_total", shard=str(shard))
+            await asyncio.sleep(1)
+
+    def start(self) -> list[asyncio.Task]:
+        self._session = ClientSession()
+        tasks = [asyncio.create_task(self.supervise(shard)) for shard in range(self.shards)]
+        tasks += [asyncio.create_task(self.forward(shard)) for shard in range(self.shards)]
+        return tasks
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+
+    def stats(self) -> dict:
+        return {"sending": self._sending, **{f"queued_{shard}": queue.qsize() for shard, queue in enumerate(self._queues)}}
+
+shard_router = ShardRouter(SHARDS, SHARD_BASE_PORT, SHARD_TOKEN)
+
+def collect_shard_gauges():
+    for key, value in shard_router.stats().items():
+        metrics.set(f"bot_shard_{key}", value)
+
+async def handle_front_webhook(request: web.Request) -> web.Response:
+    """Webhook главного процесса: 200 уходит Telegram, когда шард сохранил апдейт."""
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
+    try:
+        update = await request.json()
+        update["update_id"]
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+    await shard_router.route(update)
+    return web.Response()
+
+async def handle_shard_updates(request: web.Request) -> web.Response:
+    """Приём пачки апдейтов от главного процесса (в процессе шарда)."""
+    if request.headers.get("X-Shard-Token") != SHARD_TOKEN:
+        return web.Response(status=401)
+    try:
+        updates = await request.json()
+        for update in updates:
+            update["update_id"]
+    except (ValueError, KeyError, TypeError):
+        return web.Response(status=400)
+    for update in updates:
+        inbox.append(update)
+    return web.Response()
+
+async def run_shard_server():
+    app = web.Application()
+    app.router.add_post("/updates", handle_shard_updates)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", SHARD_BASE_PORT + SHARD_INDEX).start()
+    log.info("Шард %d из %d слушает 127.0.0.1:%d", SHARD_INDEX, SHARDS, SHARD_BASE_PORT + SHARD_INDEX)
+    try:
+        await lifecycle.stopping.wait()
+    finally:
+        await runner.cleanup()
+
+async def route_to_shards(updates: list[dict]):
+    await asyncio.gather(*(shard_router.route(update) for update in updates))
+
+async def poll_to_shards():
+    """Polling в главном процессе: offset сдвигается, только когда шарды сохранили пачку."""
+    await poll_updates(route_to_shards)
+
+async def run_front():
+    """Главный процесс в режиме шардов: приём апдейтов и раздача их шардам."""
+    logging.basicConfig(level=logging.INFO)
+    lifecycle.install_signals()
+    metrics.collectors.append(collect_shard_gauges)
+    tasks = shard_router.start()
+    metrics_server = await start_metrics_server()
+    log.info("Запущено шардов: %d", SHARDS)
+
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(handle_front_webhook)
+        else:
+            await serve_until_stopped(poll_to_shards())
+    finally:
+        # принятые апдейты сначала доезжают до шардов, потом шарды получают
+        # SIGTERM и сами дорабатывают своё (см. Lifecycle)
+        await lifecycle.drain({"к шардам": lambda: sum(shard_router.stats().values())})
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await shard_router.close()
+        if metrics_server:
+            await metrics_server.cleanup()
+        storage.close()
+        await bot.session.close()
+
+# ================== МЕТРИКИ: HTTP И EVENT LOOP ==================
+
+def collect_gauges():
+    for name, source in (
+        ("outbound", outbox.stats()),
+        ("address_cache", address_cache.stats()),
+        ("order_store", orders.stats()),
+        ("inbox", inbox.stats()),
+        ("scheduler", scheduler.stats()),
+        ("night_queue", night_queue.stats()),
+    ):
+        for key, value in source.items():
+            metrics.set(f"bot_{name}_{key}", value)
+    metrics.set("bot_ai_breaker_open", int(ai_breaker.state != CircuitBreaker.CLOSED))
+
+metrics.collectors.append(collect_gauges)
+
+async def monitor_event_loop(interval: float = 0.5):
+    """Замеряет, насколько позже положенного просыпается event loop."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        metrics.observe("bot_event_loop_lag_seconds", lag)
+        if lag > SLOW_UPDATE_THRESHOLD:
+            log.warning("Event loop был заблокирован на %.2f с", lag)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+async def start_metrics_server() -> web.AppRunner | None:
+    # в режиме webhook на том же порту /metrics обслуживает сервер webhook
+    if not METRICS_PORT or (WEBHOOK_URL and METRICS_PORT == WEBHOOK_PORT):
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, METRICS_PORT).start()
+    return runner
+
+# ================== ОСТАНОВКА ==================
+# По SIGTERM (редеплой) или SIGINT бот перестаёт принимать апдейты и в течение
+# SHUTDOWN_TIMEOUT секунд дорабатывает начатое: хендлеры с проверками ИИ,
+# фоновые задачи кнопок, отложенные правки и очередь исходящих. Апдейты,
+# которые не успели обработаться, остаются в журнале (Inbox) и проигрываются
+# при следующем старте; отложенные действия и ночные заявки и так лежат
+# в базе. Итог — что доработано и что отложено — пишется в лог.
+# Повторный сигнал обрывает ожидание.
+
+class InFlightMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event: Update, data):
+        lifecycle.begin(event)
+        try:
+            return await handler(event, data)
+        finally:
+            lifecycle.end(event)
+
+class Lifecycle:
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.stopping = asyncio.Event()
+        self.deadline: float | None = None
+        # update_id -> (апдейт, задача, которая его обрабатывает)
+        self._updates: dict[int, tuple[Update, asyncio.Task]] = {}
+
+    def install_signals(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.stop, sig.name)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: остаётся KeyboardInterrupt
+
+    def stop(self, reason: str = "stop"):
+        if self.stopping.is_set():
+            log.warning("Повторный %s: останавливаюсь, не дожидаясь начатого", reason)
+            self.deadline = time.monotonic()
+            return
+        log.info("Получен %s: приём апдейтов остановлен, дорабатываю начатое (до %g с)", reason, self.timeout)
+        self.deadline = time.monotonic() + self.timeout
+        self.stopping.set()
+
+    def begin(self, update: Update):
+        self._updates[update.update_id] = (update, asyncio.current_task())
+
+    def end(self, update: Update):
+        self._updates.pop(update.update_id, None)
+
+    def in_flight(self) -> int:
+        return len(self._updates)
+
+    async def drain(self, sources: dict[str, Callable[[], int]]) -> dict[str, tuple[int, int]]:
+        """Ждёт, пока все источники опустеют или выйдет срок. Возвращает {имя: (было, осталось)}."""
+        if self.deadline is None:
+            # выход не по сигналу (например, упал polling) — тот же срок
+            self.deadline = time.monotonic() + self.timeout
+        before = {name: count() for name, count in sources.items()}
+        while any(count() for count in sources.values()) and time.monotonic() < self.deadline:
+            await asyncio.sleep(0.05)
+        report = {name: (before[name], count()) for name, count in sources.items()}
+        log.info("Остановка: %s", ", ".join(f"{name} {was}→{left}" for name, (was, left) in report.items()))
+        return report
+
+    def checkpoint(self) -> int:
+        """Сохраняет недоработанные апдейты в журнал и прерывает их обработку."""
+        for update, task in list(self._updates.values()):
+            inbox.checkpoint(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        return len(self._updates)
+
+lifecycle = Lifecycle(SHUTDOWN_TIMEOUT)
+dp.update.outer_middleware(InFlightMiddleware())
+
+async def serve_until_stopped(intake):
+    """Выполняет intake (polling), пока не придёт сигнал остановки."""
+    task = asyncio.ensure_future(intake)
+    stop = asyncio.create_task(lifecycle.stopping.wait())
+    try:
+        await asyncio.wait({task, stop}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        stop.cancel()
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+async def shutdown(workers: list[asyncio.Task]):
+    """Дорабатывает начатое, откладывает остальное до следующего старта и пишет итог."""
+    report = await lifecycle.drain({
+        "апдейты": lambda: lifecycle.in_flight() + inbox.stats()["queued"],
+        "правки": lambda: sum(not task.done() for task, _ in pending_edits.values()),
+        "фоновые задачи": lambda: len(background_tasks),
+        "проверки ИИ": lambda: len(address_batcher._tasks),
+        "исходящие": lambda: outbox.stats()["depth"] + outbox.stats()["inflight"],
+    })
+    checkpointed = lifecycle.checkpoint()
+    queued = inbox.stats()["queued"]
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    # карточка прерванного апдейта, уже ушедшая в Telegram, должна попасть в базу
+    # до её закрытия, иначе повтор апдейта пришлёт её второй раз
+    await outbox.settle(timeout=2)
+
+    # правки, задачи кнопок и отправки, не успевшие за срок, повторить нечем
+    lost = report["правки"][1] + report["фоновые задачи"][1] + report["исходящие"][1]
+    (log.warning if lost else log.info)(
+        "Остановка завершена: прервано правок, задач и отправок: %d; "
+        "отложено до старта: апдейтов в журнале %d, действий по таймеру %d, ночных заявок %d",
+        lost, checkpointed + queued, scheduler.stats()["pending"], night_queue.stats()["held"],
+    )
+
+# ================== ЗАПУСК: ПРОГРЕВ ==================
+# Перед приёмом апдейтов бот проверяет, что всё нужное работает: токен
+# (getMe), база, разбор адреса и дифф — и пишет, сколько это заняло.
+# Пакет openai подгружается в фоне уже после старта, чтобы первая заявка
+# не ждала его импорта, а запуск — не ждал его вовсе.
+
+WARM_UP_ORDER = "Получатель: +375291234567\nул. Притыцкого 29, под. 2, эт. 5, кв. 17"
+
+async def warm_up() -> bool:
+    checks = []
+    ok = True
+
+    def timed(name: str, func):
+        start = time.perf_counter()
+        func()
+        checks.append(f"{name} {(time.perf_counter() - start) * 1000:.1f} мс")
+
+    start = time.perf_counter()
+    try:
+        me = await asyncio.wait_for(bot.get_me(), timeout=10)
+        checks.append(f"getMe @{me.username} {(time.perf_counter() - start) * 1000:.0f} мс")
+    except Exception as e:
+        ok = False
+        log.error("Прогрев: Telegram недоступен или токен неверный: %s", e)
+
+    try:
+        timed("база", lambda: storage.db.execute("SELECT 1").fetchone())
+        timed("разбор адреса", lambda: extract_address(WARM_UP_ORDER))
+        timed("контакт", lambda: validate_contact(WARM_UP_ORDER))
+        timed("дифф", lambda: diff_text(WARM_UP_ORDER, WARM_UP_ORDER.replace("17", "18")))
+    except Exception:
+        ok = False
+        log.exception("Прогрев: самопроверка не прошла")
+
+    if OPENAI_API_KEY:
+        spawn(asyncio.to_thread(importlib.import_module, "openai"))
+    else:
+        log.warning("OPENAI_API_KEY не задан — адреса проверяются только правилами")
+
+    startup = time.monotonic() - STARTED_AT
+    metrics.set("bot_startup_seconds", startup)
+    log.info("Прогрев: %s; готов к приёму апдейтов через %.2f с", ", ".join(checks), startup)
+    return ok
 
 # ================== RUN ==================
 
+def load_state():
+    """Поднимает из базы заявки, известных пользователей, автопилот и отложенные действия."""
+    records = storage.load_orders()
+    for record in records:
+        orders.add(record, save=False)
+    # заявки, сохранённые до появления истории, попадают в поиск при первом запуске
+    missing = storage.missing_history([record.card_id for record in records])
+    for record in records:
+        if record.card_id in missing:
+            storage.save_history(record)
+    known_users.update(storage.load_known_users())
+    storage.prune_request_numbers(time.time() - 7 * 24 * 3600)
+
+    restored = scheduler.load()
+    if restored:
+        log.info("Восстановлено отложенных действий: %d", restored)
+
+    held = night_queue.load()
+    if held:
+        log.info("В ночной очереди заявок: %d", held)
+
+    daily_stats.load()
+    schedule_daily_report()
+
+    for chat_id, enabled, thread_id, until in storage.load_autopilot():
+        if not enabled:
+            continue
+        autopilot_state[chat_id] = {"enabled": True}
+        # таймер продолжает отсчёт с оставшегося времени, истёкший за время
+        # простоя срабатывает сразу; база от старых версий не знала timers
+        if until is not None and f"autopilot:{chat_id}" not in scheduler:
+            schedule_autopilot_off(chat_id, thread_id, until)
+
 async def main():
-    # На случай, если ранее был установлен webhook (или есть залипший),
-    # иначе getUpdates будет конфликтовать с ним (TelegramConflictError).
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    logging.basicConfig(level=logging.INFO)
+    lifecycle.install_signals()
+    shop_config.reload()
+    load_state()
+    flush_task = asyncio.create_task(storage.run())
+    shops_watcher = asyncio.create_task(shop_config.watch(SHOPS_RELOAD_INTERVAL))
+    scheduler_task = asyncio.create_task(scheduler.run())
+
+    await warm_up()
+
+    # апдейты, не обработанные до прошлой остановки, проигрываются заново
+    replayed = inbox.open()
+    if replayed:
+        log.info("Повторная обработка апдейтов из журнала: %d", replayed)
+    workers = inbox.start(bot, dp, INBOX_WORKERS)
+    lag_monitor = asyncio.create_task(monitor_event_loop())
+    metrics_server = await start_metrics_server()
+
+    try:
+        if SHARD_INDEX is not None:
+            await run_shard_server()
+        elif WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # Перед getUpdates снимается webhook (иначе TelegramConflictError);
+            # накопившиеся за время перезапуска апдейты не сбрасываются.
+            await serve_until_stopped(poll_updates(poll_to_inbox))
+    finally:
+        # новые отложенные действия не запускаются: они в базе и сработают после старта
+        scheduler_task.cancel()
+        await shutdown(workers)
+        lag_monitor.cancel()
+        shops_watcher.cancel()
+        if metrics_server:
+            await metrics_server.cleanup()
+        flush_task.cancel()
+        storage.close()
+        address_cache.save()
+        await bot.session.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(run_front() if SHARDS > 1 and SHARD_INDEX is None else main())